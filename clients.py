@@ -0,0 +1,191 @@
+import threading
+import time
+
+import aiohttp
+import openai
+import requests
+from langchain import LLMChain
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.chat_models import ChatOpenAI
+from langchain.embeddings.openai import OpenAIEmbeddings
+from requests.adapters import HTTPAdapter
+
+from config import settings
+
+
+class LatencyStats:
+    """Call counts and latencies of the shared OpenAI clients, keyed by client name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, name, seconds, error=False):
+        with self._lock:
+            stats = self._stats.setdefault(
+                name, {"calls": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+            )
+            stats["calls"] += 1
+            stats["errors"] += int(error)
+            stats["total_seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                name: {
+                    **stats,
+                    "average_seconds": stats["total_seconds"] / stats["calls"],
+                }
+                for name, stats in self._stats.items()
+            }
+
+
+latency_stats = LatencyStats()
+
+
+class LatencyCallbackHandler(BaseCallbackHandler):
+    def __init__(self, name):
+        self.name = name
+        self._started = {}
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._started[run_id] = time.perf_counter()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        started = self._started.pop(run_id, None)
+        if started is not None:
+            latency_stats.record(self.name, time.perf_counter() - started)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        started = self._started.pop(run_id, None)
+        if started is not None:
+            latency_stats.record(self.name, time.perf_counter() - started, error=True)
+
+
+class TimedOpenAIEmbeddings(OpenAIEmbeddings):
+    """``OpenAIEmbeddings`` that records the latency of every embedding request."""
+
+    def embed_documents(self, texts, chunk_size=0):
+        started = time.perf_counter()
+        try:
+            result = super().embed_documents(texts, chunk_size)
+        except Exception:
+            latency_stats.record(f"embeddings:{self.model}", time.perf_counter() - started, error=True)
+            raise
+        latency_stats.record(f"embeddings:{self.model}", time.perf_counter() - started)
+        return result
+
+    async def aembed_documents(self, texts, chunk_size=0):
+        started = time.perf_counter()
+        try:
+            result = await super().aembed_documents(texts, chunk_size)
+        except Exception:
+            latency_stats.record(f"embeddings:{self.model}", time.perf_counter() - started, error=True)
+            raise
+        latency_stats.record(f"embeddings:{self.model}", time.perf_counter() - started)
+        return result
+
+
+_lock = threading.Lock()
+_chat_llms = {}
+_chains = {}
+_embeddings = None
+_aiohttp_session = None
+
+
+def get_chat_llm(model_name=None, temperature=None, max_tokens=None):
+    """Return the shared ``ChatOpenAI`` for a model/temperature/max_tokens combination."""
+    if model_name is None:
+        model_name = settings.CHAT_MODEL
+    if temperature is None:
+        temperature = settings.CHAT_TEMPERATURE
+    if max_tokens is None:
+        max_tokens = settings.CHAT_MAX_TOKENS
+    key = (model_name, temperature, max_tokens)
+    with _lock:
+        if key not in _chat_llms:
+            _chat_llms[key] = ChatOpenAI(
+                model_name=model_name,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                callbacks=[LatencyCallbackHandler(f"chat:{model_name}")],
+            )
+        return _chat_llms[key]
+
+
+def get_llm_chain(prompt, **llm_kwargs):
+    llm = get_chat_llm(**llm_kwargs)
+    key = (id(prompt), id(llm))
+    with _lock:
+        if key not in _chains:
+            _chains[key] = LLMChain(llm=llm, prompt=prompt)
+        return _chains[key]
+
+
+def get_embeddings():
+    global _embeddings
+    with _lock:
+        if _embeddings is None:
+            _embeddings = TimedOpenAIEmbeddings(model=settings.EMBEDDING_MODEL)
+        return _embeddings
+
+
+def _make_requests_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=settings.OPENAI_POOL_SIZE, pool_maxsize=settings.OPENAI_POOL_SIZE
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+async def startup():
+    """Create the shared clients and the keep-alive HTTP pools they send requests through."""
+    global _aiohttp_session
+    openai.requestssession = _make_requests_session()
+    _aiohttp_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=settings.OPENAI_POOL_SIZE,
+            keepalive_timeout=settings.OPENAI_KEEPALIVE_SECONDS,
+        )
+    )
+    get_chat_llm()
+    get_embeddings()
+
+
+def get_http_session():
+    """The shared keep-alive ``aiohttp`` session, or ``None`` before startup."""
+    return _aiohttp_session
+
+
+def use_shared_session():
+    """Point openai's async requests made in the current context at the shared aiohttp session."""
+    if _aiohttp_session is not None:
+        openai.aiosession.set(_aiohttp_session)
+
+
+async def shutdown():
+    global _aiohttp_session
+    if _aiohttp_session is not None:
+        await _aiohttp_session.close()
+        _aiohttp_session = None
+
+
+class OpenAISessionMiddleware:
+    """
+    Point openai's async requests at the shared aiohttp session.
+
+    openai keeps the session in a context variable, so it has to be set in the
+    context every request runs in; otherwise each call opens a new session.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        use_shared_session()
+        await self.app(scope, receive, send)
@@ -1,3 +1,6 @@
+import os
+from typing import List, Optional
+
 from pydantic import BaseSettings
 
 
@@ -8,6 +11,59 @@ class Settings(BaseSettings):
     POSTGRES_DB: str
     POSTGRES_HOSTNAME: str
     OPENAI_API_KEY: str
+    INDEX_CACHE_MAX_BYTES: int = 1024 * 1024 * 1024
+    CONSOLIDATED_INDEX: bool = False
+    CHAT_QUERY_CONCURRENCY: int = 5
+    ANSWER_CACHE_MAX_ENTRIES: int = 10000
+    ANSWER_CACHE_TTL_SECONDS: int = 24 * 60 * 60
+    ANSWER_CACHE_SIMILARITY_THRESHOLD: Optional[float] = None
+    TRANSCRIPT_FSYNC: bool = False
+    CONTEXT_TOKEN_BUDGET: int = 3000
+    CONTEXT_CANDIDATES: int = 20
+    CONTEXT_MMR_LAMBDA: float = 0.5
+    HYBRID_SEARCH: bool = True
+    HYBRID_RRF_K: int = 60
+    CHAT_MODEL: str = "gpt-3.5-turbo"
+    CHAT_TEMPERATURE: float = 0.1
+    CHAT_MAX_TOKENS: int = 2048
+    OPENAI_POOL_SIZE: int = 100
+    OPENAI_KEEPALIVE_SECONDS: int = 60
+    INGESTION_WORKERS: int = 2
+    INGESTION_QUEUE_SIZE: int = 100
+    INGESTION_STAGE_BUFFER: int = 2
+    INGESTION_SEGMENT_CHUNKS: int = 5000
+    MAX_UPLOAD_BYTES: int = 100 * 1024 * 1024
+    UPLOAD_CHUNK_SIZE: int = 1024 * 1024
+    PARSE_WORKERS: int = os.cpu_count() or 1
+    PARSE_SHARD_PAGES: int = 8
+    XLSX_DOCUMENT_TOKENS: int = 500
+    XLSX_BLOCK_ROWS: int = 1000
+    EMBEDDING_MODEL: str = "text-embedding-ada-002"
+    EMBEDDING_BATCH_SIZE: int = 256
+    EMBEDDING_MAX_IN_FLIGHT: int = 4
+    EMBEDDING_TOKENS_PER_MINUTE: int = 1000000
+    EMBEDDING_MAX_RETRIES: int = 6
+    EMBEDDING_API_BASE: Optional[str] = None
+    SEGMENT_COMPACTION_THRESHOLD: int = 8
+    INDEX_TYPE: str = "auto"
+    INDEX_SQ8_MIN_VECTORS: int = 50000
+    INDEX_IVFPQ_MIN_VECTORS: int = 250000
+    INDEX_IVF_NPROBE: int = 32
+    INDEX_PQ_SUBQUANTIZERS: Optional[int] = None
+    INDEX_MMAP: bool = False
+    EMBEDDING_CACHE_PATH: str = "embedding_cache/embeddings.sqlite3"
+    STORAGE_QUOTA_BYTES: Optional[int] = None
+    RECLAIM_INTERVAL_SECONDS: int = 60 * 60
+    RECLAIM_GRACE_SECONDS: int = 60 * 60
+    MEDIA_RETENTION_DAYS: int = 7
+    JOB_RETENTION_DAYS: int = 7
+    TRANSCRIPT_RETENTION_DAYS: Optional[int] = None
+    GMAIL_API_ENDPOINT: str = "https://gmail.googleapis.com"
+    GMAIL_MAX_MESSAGES: int = 100
+    GMAIL_FETCH_CONCURRENCY: int = 10
+    GMAIL_FETCH_MAX_RETRIES: int = 4
+    # Users allowed to read the process-wide cache and throughput counters
+    ADMIN_EMAILS: List[str] = []
 
     class Config:
         env_file = "./.env"
@@ -0,0 +1,29 @@
+"""
+Build the indexes added to the models since their tables were created.
+
+``Base.metadata.create_all`` only creates missing tables, so run this once per
+deploy, before starting the workers:
+
+    python create_indexes.py
+
+Indexes are built ``CONCURRENTLY`` so writes to large tables carry on meanwhile,
+and ``IF NOT EXISTS`` makes reruns a no-op. A build interrupted halfway leaves an
+invalid index behind; drop it and run the script again.
+"""
+from sqlalchemy.schema import CreateIndex
+
+import models.users  # noqa: F401 (registers the tables on Base.metadata)
+from database import Base, engine
+
+
+def create_indexes():
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.dialect_options["postgresql"]["concurrently"] = True
+                connection.execute(CreateIndex(index, if_not_exists=True))
+
+
+if __name__ == "__main__":
+    create_indexes()
@@ -0,0 +1,109 @@
+import asyncio
+import random
+
+import aiohttp
+
+from config import settings
+
+# Worth retrying: rate limits and transient server errors
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+# Longest wait between retries, whatever Retry-After asks for
+BACKOFF_MAX = 30.0
+# Most ids messages.list returns per page
+LIST_PAGE_SIZE = 500
+
+
+class GmailFetchError(Exception):
+    def __init__(self, message_id, status, detail):
+        super().__init__(f"Fetching message {message_id} failed with {status}: {detail}")
+        self.message_id = message_id
+        self.status = status
+
+
+def get_api_endpoint():
+    return settings.GMAIL_API_ENDPOINT.rstrip("/")
+
+
+def _backoff(attempt, retry_after=None):
+    if retry_after is not None:
+        try:
+            return min(BACKOFF_MAX, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+    return min(BACKOFF_MAX, 2 ** attempt) * (0.5 + random.random() / 2)
+
+
+async def fetch_message(session, access_token, message_id, semaphore, max_retries):
+    """
+    ``GET users/me/messages/{id}`` with retries on rate limits, server errors and
+    connection failures; raises ``GmailFetchError`` once the retries run out.
+    """
+    url = f"{get_api_endpoint()}/gmail/v1/users/me/messages/{message_id}"
+    headers = {"Authorization": f"Bearer {access_token}"}
+    for attempt in range(max_retries + 1):
+        retry_after = None
+        try:
+            async with semaphore:
+                async with session.get(url, headers=headers, params={"format": "full"}) as response:
+                    if response.status == 200:
+                        return await response.json()
+                    status, detail = response.status, await response.text()
+                    retry_after = response.headers.get("Retry-After")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            status, detail = None, str(e)
+        if (status is not None and status not in RETRYABLE_STATUSES) or attempt == max_retries:
+            raise GmailFetchError(message_id, status, detail)
+        await asyncio.sleep(_backoff(attempt, retry_after))
+
+
+async def fetch_messages(access_token, message_ids, session=None, concurrency=None, max_retries=None):
+    """
+    Fetch Gmail messages with at most ``concurrency`` requests in flight.
+
+    A message that still fails after its retries does not fail the others.
+
+    Returns:
+        tuple: (messages in the order of ``message_ids``, with ``None`` for failed
+        ones, list of the ``GmailFetchError`` of each failed message)
+    """
+    concurrency = concurrency or settings.GMAIL_FETCH_CONCURRENCY
+    max_retries = settings.GMAIL_FETCH_MAX_RETRIES if max_retries is None else max_retries
+    semaphore = asyncio.Semaphore(concurrency)
+    own_session = session is None
+    if own_session:
+        session = aiohttp.ClientSession()
+    try:
+        results = await asyncio.gather(
+            *(fetch_message(session, access_token, message_id, semaphore, max_retries) for message_id in message_ids),
+            return_exceptions=True,
+        )
+    finally:
+        if own_session:
+            await session.close()
+    for result in results:
+        if isinstance(result, BaseException) and not isinstance(result, GmailFetchError):
+            raise result
+    errors = [result for result in results if isinstance(result, GmailFetchError)]
+    return [None if isinstance(result, GmailFetchError) else result for result in results], errors
+
+
+def list_message_ids(service, query, max_messages=None):
+    """
+    Ids of the newest messages matching ``query``, at most ``max_messages``
+    (``GMAIL_MAX_MESSAGES`` by default), following ``nextPageToken`` as needed.
+    """
+    max_messages = max_messages or settings.GMAIL_MAX_MESSAGES
+    message_ids = []
+    page_token = None
+    while len(message_ids) < max_messages:
+        results = service.users().messages().list(
+            userId="me",
+            q=query,
+            maxResults=min(LIST_PAGE_SIZE, max_messages - len(message_ids)),
+            pageToken=page_token,
+        ).execute()
+        message_ids.extend(message["id"] for message in results.get("messages", []))
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            break
+    return message_ids[:max_messages]
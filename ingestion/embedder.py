@@ -0,0 +1,159 @@
+import asyncio
+import random
+import time
+
+import openai
+
+from clients import latency_stats, use_shared_session
+from config import settings
+from retrieval.context import count_tokens
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+    openai.error.APIError,
+)
+
+
+class EmbeddingRateLimited(Exception):
+    """The embedding API kept refusing requests after every retry."""
+
+
+class TokenBucket:
+    """
+    Async token bucket refilled continuously at ``tokens_per_minute``.
+
+    ``acquire`` waits until the requested number of tokens is available, so the
+    requests it guards stay under the API's tokens-per-minute limit.
+    """
+
+    def __init__(self, tokens_per_minute: int):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60
+        self.tokens = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, tokens):
+        # A single request larger than the bucket waits for a full bucket instead of forever
+        tokens = min(tokens, self.capacity)
+        async with self._lock:
+            self._refill()
+            while self.tokens < tokens:
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= tokens
+
+
+class EmbeddingEngine:
+    """
+    Batched, concurrent embedding client for ingestion.
+
+    Texts are sent in batches of ``batch_size`` with at most ``max_in_flight``
+    requests outstanding, each admitted by a tokens-per-minute ``TokenBucket``.
+    Rate limits and transient API errors are retried with exponential backoff and
+    jitter, honouring ``Retry-After`` when the API sends it. ``on_batch`` is called
+    as each batch completes, which is where callers checkpoint finished vectors.
+
+    ``api_base`` points the engine at another OpenAI-compatible server, such as a
+    local fake used to exercise the limiter and retries.
+    """
+
+    def __init__(
+            self,
+            model=None,
+            batch_size=None,
+            max_in_flight=None,
+            tokens_per_minute=None,
+            max_retries=None,
+            api_base=None,
+            backoff_base=1.0,
+            backoff_max=60.0,
+    ):
+        self.model = model or settings.EMBEDDING_MODEL
+        self.batch_size = batch_size or settings.EMBEDDING_BATCH_SIZE
+        self.max_in_flight = max_in_flight or settings.EMBEDDING_MAX_IN_FLIGHT
+        self.bucket = TokenBucket(tokens_per_minute or settings.EMBEDDING_TOKENS_PER_MINUTE)
+        self.max_retries = settings.EMBEDDING_MAX_RETRIES if max_retries is None else max_retries
+        self.api_base = api_base or settings.EMBEDDING_API_BASE
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def _backoff(self, attempt, error):
+        retry_after = getattr(error, "headers", {}).get("retry-after")
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        delay = min(self.backoff_base * 2 ** attempt, self.backoff_max)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def _request(self, texts):
+        kwargs = {"input": texts, "model": self.model}
+        if self.api_base:
+            kwargs["api_base"] = self.api_base
+        started = time.perf_counter()
+        try:
+            response = await openai.Embedding.acreate(**kwargs)
+        except Exception:
+            latency_stats.record(f"embeddings:{self.model}", time.perf_counter() - started, error=True)
+            raise
+        latency_stats.record(f"embeddings:{self.model}", time.perf_counter() - started)
+        data = sorted(response["data"], key=lambda item: item["index"])
+        return [item["embedding"] for item in data]
+
+    async def _embed_batch(self, texts, tokens):
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire(tokens)
+            try:
+                return await self._request(texts)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    if isinstance(e, openai.error.RateLimitError):
+                        raise EmbeddingRateLimited(str(e)) from e
+                    raise
+                await asyncio.sleep(self._backoff(attempt, e))
+
+    async def embed(self, texts, on_batch=None):
+        """
+        Embed ``texts`` and return their vectors in order.
+
+        Args:
+            texts: The chunk texts to embed.
+            on_batch: Optional ``callback(positions, vectors)`` run as each batch finishes.
+        """
+        use_shared_session()
+        token_counts = count_tokens(texts) if texts else []
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        vectors = [None] * len(texts)
+
+        async def run(start):
+            positions = range(start, min(start + self.batch_size, len(texts)))
+            batch = [texts[position] for position in positions]
+            async with semaphore:
+                batch_vectors = await self._embed_batch(
+                    batch, int(sum(token_counts[position] for position in positions))
+                )
+            for position, vector in zip(positions, batch_vectors):
+                vectors[position] = vector
+            if on_batch is not None:
+                on_batch(list(positions), batch_vectors)
+
+        tasks = [asyncio.create_task(run(start)) for start in range(0, len(texts), self.batch_size)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        return vectors
@@ -0,0 +1,81 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+from config import settings
+
+# SQLite caps the number of bound parameters per statement
+LOOKUP_BATCH_SIZE = 500
+
+
+def embedding_key(text, model):
+    """Content address of a chunk: the hash of the embedding model and the chunk text."""
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent chunk embedding cache shared by every upload and worker process.
+
+    Vectors are stored as float32 blobs in a local SQLite database keyed by
+    ``embedding_key``, so re-uploading a document, or a revision that shares most
+    of its chunks, only sends the unseen chunks to the embedding API.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, model TEXT NOT NULL, vector BLOB NOT NULL)"
+            )
+            self._local.connection = connection
+        return connection
+
+    def get_many(self, texts, model):
+        """Return ``{position in texts: vector}`` for every text already embedded with ``model``."""
+        keys = [embedding_key(text, model) for text in texts]
+        positions = {}
+        for position, key in enumerate(keys):
+            positions.setdefault(key, []).append(position)
+
+        found = {}
+        unique_keys = list(positions)
+        connection = self._connection()
+        for start in range(0, len(unique_keys), LOOKUP_BATCH_SIZE):
+            batch = unique_keys[start:start + LOOKUP_BATCH_SIZE]
+            rows = connection.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                batch,
+            ).fetchall()
+            for key, blob in rows:
+                vector = np.frombuffer(blob, dtype=np.float32).tolist()
+                for position in positions[key]:
+                    found[position] = vector
+        return found
+
+    def put_many(self, texts, vectors, model):
+        rows = [
+            (embedding_key(text, model), model, np.asarray(vector, dtype=np.float32).tobytes())
+            for text, vector in zip(texts, vectors)
+        ]
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, model, vector) VALUES (?, ?, ?)", rows
+            )
+
+
+embedding_cache = EmbeddingCache(settings.EMBEDDING_CACHE_PATH)
@@ -0,0 +1,240 @@
+import asyncio
+import datetime
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+
+JOB_ROOT = "train_jobs"
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+# Progress counters are written out at most this often; status changes always are
+PROGRESS_SAVE_INTERVAL = 0.5
+
+# Server-side paths kept in the job record but not shown to users
+PRIVATE_FIELDS = ("file_path", "workspace")
+
+# Counters every run starts from
+INITIAL_PROGRESS = {"pages_parsed": 0, "chunks_total": 0, "chunks_embedded": 0}
+
+
+def get_job_path(job_id):
+    return os.path.join(JOB_ROOT, f"{job_id}.json")
+
+
+def load_job(job_id):
+    """Read the last recorded state of a job, or ``None`` if it is unknown."""
+    try:
+        with open(get_job_path(job_id)) as job_file:
+            return json.load(job_file)
+    except (OSError, ValueError):
+        return None
+
+
+def claim_retry(job_id, customer_id):
+    """
+    Take a failed, retryable job for a new run and return it, or ``None`` if it is
+    not the user's, not retryable or already claimed.
+
+    The record is checked and marked queued under an ``flock`` on the job, so two
+    retry requests, even in different worker processes, never both run it.
+    """
+    os.makedirs(JOB_ROOT, exist_ok=True)
+    with open(f"{get_job_path(job_id)}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            record = load_job(job_id)
+            if (
+                    record is None
+                    or record["customer_id"] != str(customer_id)
+                    or record["status"] != FAILED
+                    or not record.get("retryable")
+                    or not os.path.exists(record["file_path"])
+            ):
+                return None
+            job = IngestionJob.from_dict(record)
+            job.status = QUEUED
+            job.save()
+            return job
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def public_view(record):
+    return {key: value for key, value in record.items() if key not in PRIVATE_FIELDS}
+
+
+class IngestionJob:
+    """
+    A single ``/train`` upload waiting to be parsed, split, embedded and indexed.
+
+    The state is written to ``train_jobs/{job_id}.json`` on every change, so
+    ``/train/jobs/{job_id}`` can be answered by any worker process, not only the
+    one running the job.
+    """
+
+    def __init__(self, customer_id, chat_id, data_id, filename, extension, file_path, workspace, file_size,
+                 sha256=None, job_id=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.customer_id = str(customer_id)
+        self.chat_id = chat_id
+        self.data_id = str(data_id)
+        self.filename = filename
+        self.extension = extension
+        self.file_path = file_path
+        self.workspace = workspace
+        self.file_size = file_size
+        self.sha256 = sha256
+        self.status = QUEUED
+        self.progress = dict(INITIAL_PROGRESS)
+        self.message = None
+        self.retryable = False
+        self.result = None
+        self.created_at = datetime.datetime.utcnow().isoformat()
+        self.updated_at = self.created_at
+        self._lock = threading.Lock()
+        self._saved_at = 0.0
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "customer_id": self.customer_id,
+            "chat_id": self.chat_id,
+            "data_id": self.data_id,
+            "filename": self.filename,
+            "extension": self.extension,
+            "file_path": self.file_path,
+            "workspace": self.workspace,
+            "file_size": self.file_size,
+            "sha256": self.sha256,
+            "progress": dict(self.progress),
+            "message": self.message,
+            "retryable": self.retryable,
+            "result": self.result,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+    @classmethod
+    def from_dict(cls, record):
+        """Rebuild a job from its saved record, e.g. to retry it."""
+        job = cls(
+            customer_id=record["customer_id"],
+            chat_id=record["chat_id"],
+            data_id=record["data_id"],
+            filename=record["filename"],
+            extension=record["extension"],
+            file_path=record["file_path"],
+            workspace=record["workspace"],
+            file_size=record["file_size"],
+            sha256=record.get("sha256"),
+            job_id=record["job_id"],
+        )
+        job.progress.update(record.get("progress", {}))
+        job.created_at = record["created_at"]
+        return job
+
+    def save(self):
+        os.makedirs(JOB_ROOT, exist_ok=True)
+        with self._lock:
+            self.updated_at = datetime.datetime.utcnow().isoformat()
+            path = get_job_path(self.id)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w") as job_file:
+                json.dump(self.to_dict(), job_file)
+            os.replace(tmp_path, path)
+            self._saved_at = time.monotonic()
+
+    def _save_progress(self):
+        if time.monotonic() - self._saved_at >= PROGRESS_SAVE_INTERVAL:
+            self.save()
+
+    def update(self, **progress):
+        """Record progress counters; safe to call from the threadpool."""
+        with self._lock:
+            self.progress.update(progress)
+        self._save_progress()
+
+    def advance(self, **increments):
+        with self._lock:
+            for key, value in increments.items():
+                self.progress[key] = self.progress.get(key, 0) + value
+        self._save_progress()
+
+    def start(self):
+        # A retry counts from zero again; cached embeddings make the repeat cheap
+        self.progress = dict(INITIAL_PROGRESS)
+        self.status = RUNNING
+        self.message = None
+        self.retryable = False
+        self.save()
+
+    def succeed(self, message, result=None):
+        self.status = SUCCEEDED
+        self.message = message
+        self.result = result
+        self.save()
+
+    def fail(self, message, retryable=False):
+        """Mark the job failed; ``retryable`` jobs keep their upload so they can be resumed."""
+        self.status = FAILED
+        self.message = message
+        self.retryable = retryable
+        self.save()
+
+
+class JobQueue:
+    """
+    Bounded in-process stand-in for a job broker.
+
+    ``submit`` puts a job on an ``asyncio.Queue`` drained by a fixed number of
+    worker tasks running ``handler(job)``; when the queue is full new uploads are
+    refused instead of piling up. Jobs only live in the memory of the process that
+    accepted them, so a restart drops anything still queued.
+    """
+
+    def __init__(self, handler, workers: int, max_pending: int):
+        self.handler = handler
+        self.workers = workers
+        self._queue = asyncio.Queue(maxsize=max_pending)
+        self._tasks = []
+
+    async def start(self):
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._work()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, job: IngestionJob):
+        """Queue ``job``; raises ``asyncio.QueueFull`` when the backlog is at capacity."""
+        self._queue.put_nowait(job)
+        job.status = QUEUED
+        job.save()
+        return job
+
+    def pending(self):
+        return self._queue.qsize()
+
+    async def _work(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self.handler(job)
+            except asyncio.CancelledError:
+                job.fail("Ingestion was interrupted, please upload the file again")
+                raise
+            except Exception as e:
+                job.fail(f"Error: {str(e)}")
+            finally:
+                self._queue.task_done()
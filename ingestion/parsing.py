@@ -0,0 +1,77 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import pypdf
+from langchain.docstore.document import Document
+from langchain.document_loaders import UnstructuredWordDocumentLoader
+
+from config import settings
+
+_lock = threading.Lock()
+_pool = None
+
+
+def get_parse_pool():
+    """
+    Return the process pool shared by every ingestion job, creating it on first use.
+
+    Workers are started from a forkserver rather than forked from the server
+    process, whose other threads may hold locks a forked child would inherit.
+    """
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=settings.PARSE_WORKERS, mp_context=multiprocessing.get_context("forkserver")
+            )
+        return _pool
+
+
+async def shutdown():
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def _extract_pdf_pages(file_path, start, stop):
+    """Extract the text of pages ``start`` to ``stop`` (exclusive); runs in a pool worker."""
+    reader = pypdf.PdfReader(file_path)
+    return [reader.pages[page_number].extract_text() for page_number in range(start, stop)]
+
+
+def _load_docx(file_path):
+    return UnstructuredWordDocumentLoader(file_path).load()
+
+
+def iter_pdf_pages(file_path, shard_pages=None):
+    """
+    Yield one ``Document`` per PDF page, in page order, as shards finish parsing.
+
+    The page range is split into shards of ``shard_pages`` pages that are parsed in
+    parallel by the process pool, so text extraction scales with cores instead of
+    running under one GIL. Shards are yielded in order, each as soon as it and every
+    shard before it are done. Documents match ``PyPDFLoader``: the text of the page
+    with ``{"source": file_path, "page": page_number}`` metadata, numbered from 0.
+    """
+    shard_pages = shard_pages or settings.PARSE_SHARD_PAGES
+    page_count = len(pypdf.PdfReader(file_path).pages)
+    pool = get_parse_pool()
+    futures = [
+        (start, pool.submit(_extract_pdf_pages, file_path, start, min(start + shard_pages, page_count)))
+        for start in range(0, page_count, shard_pages)
+    ]
+    try:
+        for start, future in futures:
+            for offset, text in enumerate(future.result()):
+                yield Document(page_content=text, metadata={"source": file_path, "page": start + offset})
+    finally:
+        for _, future in futures:
+            future.cancel()
+
+
+def iter_docx_documents(file_path):
+    """DOCX has no page boundaries to shard on; the whole file is parsed in one pool worker."""
+    yield from get_parse_pool().submit(_load_docx, file_path).result()
@@ -0,0 +1,281 @@
+import asyncio
+import datetime
+import os
+import traceback
+
+import numpy as np
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from langchain.text_splitter import TokenTextSplitter
+
+from clients import get_embeddings
+from config import settings
+from database import session
+from ingestion.embedder import EmbeddingEngine, EmbeddingRateLimited
+from ingestion.embedding_cache import embedding_cache
+from ingestion.jobs import IngestionJob, JobQueue
+from ingestion.parsing import iter_docx_documents, iter_pdf_pages
+from ingestion.spreadsheets import iter_xlsx_documents
+from ingestion.stages import DONE, Stage, StageStats, drain, run_stages
+from retrieval import index_types
+from retrieval.consolidated import add_to_consolidated_index, remove_from_consolidated_index
+from retrieval.segments import append_segment, remove_index, segment_path
+from storage import UPLOAD_ROOT, path_size, remove_path, storage_usage
+
+TEMP_ROOT = UPLOAD_ROOT
+
+SUCCESS_MESSAGES = {
+    ".pdf": "PDF EMBEDDINGS GENERATED SUCCESSFULLY",
+    ".docx": "DOCX EMBEDDINGS GENERATED SUCCESSFULLY",
+    ".xlsx": "XLSX EMBEDDINGS GENERATED SUCCESSFULLY",
+}
+
+
+def log_error(customer_id, error_message, traceback_str):
+    error_folder = "train_error_logs"
+    os.makedirs(error_folder, exist_ok=True)
+    error_log_path = os.path.join(error_folder, f"error_log_{customer_id}.txt")
+
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with open(error_log_path, "a") as error_log:
+        error_log.write(f"[{timestamp}] {error_message}\n")
+        error_log.write(traceback_str + "\n")
+
+
+def get_persist_directory(customer_id, data_id):
+    return f"trained_db/{customer_id}/{data_id}_all_embeddings"
+
+
+def get_job_workspace(customer_id, job_id):
+    return os.path.join(TEMP_ROOT, str(customer_id), job_id)
+
+
+def iter_documents(job: IngestionJob):
+    """Yield the uploaded file as documents: one per PDF page, DOCX file or group of XLSX rows."""
+    if job.extension == ".pdf":
+        return iter_pdf_pages(job.file_path)
+    if job.extension == ".docx":
+        return iter_docx_documents(job.file_path)
+    return iter_xlsx_documents(job.file_path)
+
+
+def get_text_splitter(job: IngestionJob):
+    if job.extension == ".pdf":
+        return TokenTextSplitter(chunk_size=1024, chunk_overlap=256)
+    if job.extension == ".docx":
+        return TokenTextSplitter(chunk_size=500, chunk_overlap=0)
+    return None
+
+
+def split_document(job: IngestionJob, text_splitter, document):
+    chunks = text_splitter.split_documents([document]) if text_splitter else [document]
+    if job.extension == ".pdf":
+        for docs in chunks:
+            docs.metadata["page"] = docs.metadata.get("page") + 1
+            docs.metadata["filename"] = job.filename.lower()
+    return chunks
+
+
+async def embed_documents(job: IngestionJob, documents):
+    """
+    Embed the chunks of ``documents`` and return their vectors in order.
+
+    Chunks found in the embedding cache are not sent to the API, and every batch
+    the engine finishes is written to the cache straight away. The cache therefore
+    doubles as the job checkpoint: a retried job only embeds what is still missing.
+    The hit rate so far is recorded on the job.
+    """
+    texts = [doc.page_content for doc in documents]
+    model = embedding_engine.model
+    vectors = await run_in_threadpool(embedding_cache.get_many, texts, model)
+    misses = [position for position in range(len(texts)) if position not in vectors]
+    job.advance(
+        chunks_embedded=len(vectors),
+        embedding_cache_hits=len(vectors),
+        embedding_cache_misses=len(misses),
+    )
+    hits = job.progress["embedding_cache_hits"]
+    looked_up = hits + job.progress["embedding_cache_misses"]
+    job.update(embedding_cache_hit_rate=round(hits / looked_up, 4) if looked_up else 0.0)
+
+    def checkpoint(batch, batch_vectors):
+        batch_texts = [texts[misses[position]] for position in batch]
+        embedding_cache.put_many(batch_texts, batch_vectors, model)
+        job.advance(chunks_embedded=len(batch))
+
+    missing_vectors = await embedding_engine.embed([texts[position] for position in misses], checkpoint)
+    vectors.update(zip(misses, missing_vectors))
+    return [vectors[position] for position in range(len(texts))]
+
+
+def build_store(documents, vectors, embeddings):
+    return index_types.build_store(
+        [(doc.page_content, vector) for doc, vector in zip(documents, vectors)],
+        embeddings,
+        metadatas=[doc.metadata for doc in documents],
+    )
+
+
+def publish(job: IngestionJob, new_vectordb, embeddings):
+    persist_directory = get_persist_directory(job.customer_id, job.data_id)
+    paths = [segment_path(persist_directory, append_segment(persist_directory, new_vectordb))]
+    if settings.CONSOLIDATED_INDEX:
+        paths.append(add_to_consolidated_index(job.customer_id, job.data_id, new_vectordb, embeddings))
+    storage_usage.add(job.customer_id, sum(path_size(path) for path in paths))
+
+
+def discard(job: IngestionJob, embeddings):
+    """Remove whatever a failed job already wrote to the user's indexes."""
+    remove_index(get_persist_directory(job.customer_id, job.data_id))
+    if settings.CONSOLIDATED_INDEX:
+        remove_from_consolidated_index(job.customer_id, job.data_id, embeddings)
+    storage_usage.forget(job.customer_id)
+
+
+class IndexWriter:
+    """
+    Last stage of the pipeline: collects embedded chunks and publishes them as a
+    new segment every ``segment_chunks`` chunks, so only one segment's worth of
+    vectors is held in memory. Compaction merges the segments later.
+    """
+
+    def __init__(self, job: IngestionJob, embeddings, segment_chunks: int = None):
+        self.job = job
+        self.embeddings = embeddings
+        self.segment_chunks = segment_chunks or settings.INGESTION_SEGMENT_CHUNKS
+        self.documents = []
+        self.vectors = []
+        self.published = False
+
+    def add(self, documents, vectors):
+        self.documents.extend(documents)
+        self.vectors.append(np.asarray(vectors, dtype=np.float32))
+        if len(self.documents) >= self.segment_chunks:
+            self.flush()
+
+    def flush(self):
+        if not self.documents:
+            return
+        new_vectordb = build_store(self.documents, np.concatenate(self.vectors), self.embeddings)
+        self.documents, self.vectors = [], []
+        self.published = True
+        publish(self.job, new_vectordb, self.embeddings)
+
+    def close(self):
+        self.flush()
+        if not self.published:
+            raise ValueError("No text could be extracted from the file")
+
+
+async def run_pipeline(job: IngestionJob, writer: IndexWriter):
+    """
+    Stream the uploaded file through the parse, split, embed and index stages.
+
+    The stages run concurrently and hand their output on through bounded queues
+    of ``INGESTION_STAGE_BUFFER`` items, so a slow stage holds back the ones
+    before it instead of letting parsed pages or vectors pile up: memory stays
+    proportional to the embedding batches in flight plus one segment, whatever
+    the size of the file. ``chunks_total`` counts up as the file is split.
+    Per-stage counters are recorded on the job and added to ``stage_stats``.
+    """
+    stats = StageStats()
+    documents = asyncio.Queue(maxsize=settings.INGESTION_STAGE_BUFFER)
+    chunks = asyncio.Queue(maxsize=settings.INGESTION_STAGE_BUFFER)
+    batches = asyncio.Queue(maxsize=settings.INGESTION_STAGE_BUFFER)
+    text_splitter = get_text_splitter(job)
+    group_size = embedding_engine.batch_size * embedding_engine.max_in_flight
+
+    async def parse():
+        stage = Stage("parse", stats)
+        async for document in stage.iterate(iter_documents(job)):
+            job.advance(pages_parsed=1)
+            await stage.put(documents, document)
+        await documents.put(DONE)
+
+    async def split():
+        stage = Stage("split", stats)
+        async for document in drain(documents):
+            split_docs = await stage.run(run_in_threadpool, split_document, job, text_splitter, document)
+            job.advance(chunks_total=len(split_docs))
+            await stage.put(chunks, split_docs)
+        await chunks.put(DONE)
+
+    async def embed():
+        # Enough chunks to keep every embedding request slot busy
+        stage = Stage("embed", stats)
+        group = []
+        async for split_docs in drain(chunks):
+            group.extend(split_docs)
+            while len(group) >= group_size:
+                batch, group = group[:group_size], group[group_size:]
+                vectors = await stage.run(embed_documents, job, batch, items=len(batch))
+                await stage.put(batches, (batch, vectors))
+        if group:
+            vectors = await stage.run(embed_documents, job, group, items=len(group))
+            await stage.put(batches, (group, vectors))
+        await batches.put(DONE)
+
+    async def index():
+        stage = Stage("index", stats)
+        async for batch, vectors in drain(batches):
+            await stage.run(run_in_threadpool, writer.add, batch, vectors, items=len(batch))
+        await stage.run(run_in_threadpool, writer.close, items=0)
+
+    try:
+        await run_stages(parse(), split(), embed(), index())
+    finally:
+        job.update(stages=stats.snapshot())
+        stage_stats.merge(stats)
+
+
+async def run_ingestion(job: IngestionJob):
+    """
+    Parse, split, embed and index an uploaded file.
+
+    The ``UserTrainData`` row is only created once the index has been written, so
+    a failed job never leaves a document the user can select but not query.
+    """
+    # utils imports models.users, which imports utils back; importing it at module
+    # level breaks any import chain that reaches this module before models
+    from utils import create_train_data
+
+    job.start()
+    embeddings = get_embeddings()
+    writer = IndexWriter(job, embeddings)
+    try:
+        await run_pipeline(job, writer)
+
+        with session() as db:
+            trained_data_object = await create_train_data(
+                db,
+                id=job.data_id,
+                source_filename=job.filename,
+                source_file_extensions=job.extension,
+                trained_data_path=get_persist_directory(job.customer_id, job.data_id),
+                user_id=job.customer_id,
+                chat_id=job.chat_id,
+                file_size=job.file_size,
+            )
+            result = jsonable_encoder(trained_data_object)
+        job.succeed(SUCCESS_MESSAGES[job.extension], result)
+    except EmbeddingRateLimited as e:
+        log_error(job.customer_id, f"Embedding rate limit: {str(e)}", traceback.format_exc())
+        # The embedding cache keeps the finished batches; the retry republishes from scratch
+        if writer.published:
+            await run_in_threadpool(discard, job, embeddings)
+        job.fail("Rate limit reached for your account, retry the job to resume", retryable=True)
+    except Exception as e:
+        error_message = f"Error processing {job.extension.upper()[1:]}: {str(e)}"
+        log_error(job.customer_id, error_message, traceback.format_exc())
+        if writer.published:
+            await run_in_threadpool(discard, job, embeddings)
+        job.fail("file upload unsuccessful")
+    finally:
+        if not job.retryable:
+            remove_path(job.customer_id, job.workspace)
+
+
+embedding_engine = EmbeddingEngine()
+# Stage counters of every job this process has run
+stage_stats = StageStats()
+job_queue = JobQueue(run_ingestion, settings.INGESTION_WORKERS, settings.INGESTION_QUEUE_SIZE)
@@ -0,0 +1,113 @@
+import numpy as np
+import openpyxl
+import pandas as pd
+from langchain.docstore.document import Document
+
+from config import settings
+from retrieval.context import count_tokens
+
+SEPARATOR = " | "
+
+
+def iter_row_blocks(file_path, block_rows):
+    """
+    Stream the rows of every sheet as (sheet name, first row number, rows) blocks.
+
+    The workbook is opened read-only, so openpyxl reads rows from the file as they
+    are iterated instead of loading every cell first.
+    """
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            block, first_row = [], 1
+            for row_number, row in enumerate(sheet.iter_rows(values_only=True), start=1):
+                if not block:
+                    first_row = row_number
+                block.append(row)
+                if len(block) == block_rows:
+                    yield sheet.title, first_row, block
+                    block = []
+            if block:
+                yield sheet.title, first_row, block
+    finally:
+        workbook.close()
+
+
+def format_rows(rows):
+    """
+    Format a block of rows as ``"first cell: other | cells"`` strings, column-wise.
+
+    With two columns this is the ``"key: value"`` format the first column/second
+    column rows were trained with before. Empty cells are left out; rows without any
+    value come back as empty strings.
+    """
+    cells = pd.DataFrame(rows, dtype=object).fillna("").astype(str).apply(lambda column: column.str.strip())
+    first = cells.iloc[:, 0]
+    if cells.shape[1] > 1:
+        rest = cells.iloc[:, 1].str.cat(
+            [cells.iloc[:, i] for i in range(2, cells.shape[1])], sep=SEPARATOR
+        )
+        rest = rest.str.replace(r"(?: \| )+", SEPARATOR, regex=True).str.strip(" |")
+    else:
+        rest = pd.Series("", index=cells.index)
+    text = first.str.cat(rest, sep=": ")
+    text = text.mask(rest == "", first)
+    return text.mask(first == "", rest).to_list()
+
+
+def group_rows(token_counts, token_budget):
+    """Greedily cut rows into consecutive groups of at most ``token_budget`` tokens; returns the cut points."""
+    cuts, total = [], 0
+    for position, tokens in enumerate(token_counts.tolist()):
+        if total and total + tokens > token_budget:
+            cuts.append(position)
+            total = 0
+        total += tokens
+    return cuts
+
+
+def iter_xlsx_documents(file_path, token_budget=None, block_rows=None):
+    """
+    Yield the rows of a workbook grouped into documents of about ``token_budget`` tokens.
+
+    Rows are read and formatted a block at a time, so memory stays flat however
+    large the sheet is, and many short rows share one document (and one embedding)
+    instead of one each. Each document records its sheet and row range.
+    """
+    token_budget = token_budget or settings.XLSX_DOCUMENT_TOKENS
+    block_rows = block_rows or settings.XLSX_BLOCK_ROWS
+    pending_sheet, pending_rows, pending_texts, pending_tokens = None, [], [], 0
+
+    def flush():
+        return Document(
+            page_content="\n".join(pending_texts),
+            metadata={"sheet": pending_sheet, "rows": f"{pending_rows[0]}-{pending_rows[-1]}"},
+        )
+
+    for sheet, first_row, rows in iter_row_blocks(file_path, block_rows):
+        texts = np.array(format_rows(rows), dtype=object)
+        row_numbers = np.arange(first_row, first_row + len(rows))
+        keep = texts != ""
+        texts, row_numbers = texts[keep], row_numbers[keep]
+        if not len(texts):
+            continue
+        if pending_texts and sheet != pending_sheet:
+            yield flush()
+            pending_rows, pending_texts, pending_tokens = [], [], 0
+        pending_sheet = sheet
+
+        # Continue the group left open by the previous block, then cut the rest
+        token_counts = count_tokens(texts.tolist())
+        token_counts[0] += pending_tokens
+        cuts = group_rows(token_counts, token_budget)
+        starts = [0] + cuts
+        ends = cuts + [len(texts)]
+        for start, end in zip(starts, ends):
+            pending_texts.extend(texts[start:end].tolist())
+            pending_rows.extend(row_numbers[start:end].tolist())
+            if end != len(texts):
+                yield flush()
+                pending_rows, pending_texts = [], []
+        pending_tokens = int(token_counts[starts[-1]:].sum())
+    if pending_texts:
+        yield flush()
@@ -0,0 +1,105 @@
+import asyncio
+import threading
+import time
+
+from starlette.concurrency import iterate_in_threadpool
+
+# Put on a stage queue after the last item
+DONE = object()
+
+
+class StageStats:
+    """
+    Throughput counters of the ingestion stages, keyed by stage name.
+
+    ``busy_seconds`` is the time a stage spent working on its items and
+    ``blocked_seconds`` the time it waited for the next stage to make room in the
+    queue between them, so a stage with a high ``blocked_seconds`` is held back by
+    the one after it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, name, items=0, busy_seconds=0.0, blocked_seconds=0.0):
+        with self._lock:
+            stats = self._stats.setdefault(
+                name, {"items": 0, "busy_seconds": 0.0, "blocked_seconds": 0.0}
+            )
+            stats["items"] += items
+            stats["busy_seconds"] += busy_seconds
+            stats["blocked_seconds"] += blocked_seconds
+
+    def merge(self, other):
+        for name, stats in other.snapshot().items():
+            self.record(name, stats["items"], stats["busy_seconds"], stats["blocked_seconds"])
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                name: {
+                    **stats,
+                    "items_per_second": stats["items"] / stats["busy_seconds"] if stats["busy_seconds"] else 0.0,
+                }
+                for name, stats in self._stats.items()
+            }
+
+
+class Stage:
+    """Timing helpers for one stage, reporting to a ``StageStats``."""
+
+    def __init__(self, name, stats: StageStats):
+        self.name = name
+        self.stats = stats
+
+    async def run(self, function, *args, items=1):
+        """Await ``function(*args)`` and count it as ``items`` items of busy time."""
+        started = time.perf_counter()
+        result = await function(*args)
+        self.stats.record(self.name, items=items, busy_seconds=time.perf_counter() - started)
+        return result
+
+    async def iterate(self, iterator):
+        """Step through a blocking iterator in the threadpool, timing every item."""
+        iterator = iterate_in_threadpool(iterator).__aiter__()
+        while True:
+            started = time.perf_counter()
+            try:
+                item = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            self.stats.record(self.name, items=1, busy_seconds=time.perf_counter() - started)
+            yield item
+
+    async def put(self, queue: asyncio.Queue, item):
+        """Hand ``item`` to the next stage, waiting while its queue is full."""
+        started = time.perf_counter()
+        await queue.put(item)
+        self.stats.record(self.name, blocked_seconds=time.perf_counter() - started)
+
+
+async def drain(queue: asyncio.Queue):
+    """Yield the items of a stage queue until ``DONE``."""
+    while True:
+        item = await queue.get()
+        if item is DONE:
+            return
+        yield item
+
+
+async def run_stages(*stages):
+    """
+    Run the stage coroutines concurrently until all of them finish.
+
+    The first stage to fail cancels the others, so a stage blocked on a full or
+    empty queue never outlives the pipeline, and its exception is raised.
+    """
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
@@ -0,0 +1,36 @@
+import hashlib
+
+from fastapi import UploadFile
+
+from config import settings
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+async def save_upload(file: UploadFile, file_path, max_bytes=None, chunk_size=None):
+    """
+    Copy an upload to ``file_path`` in fixed-size chunks.
+
+    The size limit is enforced while copying and the SHA-256 of the content is
+    computed in the same pass, so the file is never held in memory or read twice.
+
+    Returns:
+        tuple: (size in bytes, hex SHA-256 digest)
+    """
+    max_bytes = max_bytes or settings.MAX_UPLOAD_BYTES
+    chunk_size = chunk_size or settings.UPLOAD_CHUNK_SIZE
+    digest = hashlib.sha256()
+    size = 0
+    with open(file_path, "wb") as f:
+        while True:
+            chunk = await file.read(chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLarge(f"{file.filename} is larger than {max_bytes} bytes")
+            digest.update(chunk)
+            f.write(chunk)
+    return size, digest.hexdigest()
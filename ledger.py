@@ -0,0 +1,59 @@
+import threading
+
+from sqlalchemy import insert, update
+
+from models.users import User, UserCreditHistory
+
+
+def deduct_credit(db, user_id, amount):
+    """Atomically subtract ``amount`` from the user's credit and return the new balance."""
+    statement = (
+        update(User)
+        .where(User.id == user_id)
+        .values(credit=User.credit - amount)
+        .returning(User.credit)
+        .execution_options(synchronize_session=False)
+    )
+    return db.execute(statement).scalar_one()
+
+
+def get_balance(db, user_id):
+    return db.query(User.credit).filter(User.id == user_id).scalar()
+
+
+def get_balance_by_email(db, email):
+    """Credit of the user with ``email`` (the JWT subject), without loading the rest of the row."""
+    return db.query(User.credit).filter(User.email == email).scalar()
+
+
+class CreditLedger:
+    """
+    Collects the charges made while serving one request.
+
+    ``flush`` settles them in a single transaction: one ``UPDATE ... RETURNING`` for the
+    summed amount, so concurrent requests never race on the balance, and one bulk
+    insert of the ``UserCreditHistory`` rows.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.charges = []
+        self._lock = threading.Lock()
+
+    def charge(self, cost):
+        if cost:
+            with self._lock:
+                self.charges.append(cost)
+
+    def flush(self, db):
+        with self._lock:
+            charges, self.charges = self.charges, []
+        if not charges:
+            return None
+        balance = deduct_credit(db, self.user_id, sum(charges))
+        db.execute(
+            insert(UserCreditHistory),
+            [{"user_id": self.user_id, "credit": cost} for cost in charges],
+        )
+        db.commit()
+        return balance
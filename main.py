@@ -5,8 +5,13 @@ from fastapi.responses import JSONResponse
 from fastapi_jwt_auth import AuthJWT
 from fastapi_jwt_auth.exceptions import AuthJWTException
 
+import clients
 from config import settings
 from database import engine, Base
+from ingestion import parsing
+from ingestion.pipeline import job_queue
+from reclaimer import reclaimer
+from retrieval.segments import compactor
 from models.schemas import Settings
 from routers import chat
 from routers import vector, users, templates, auth
@@ -19,6 +24,7 @@ app = FastAPI()
 # app.redoc_url = "/api/redoc"
 
 Base.metadata.create_all(bind=engine)
+# create_all skips tables that already exist; indexes added since are built by create_indexes.py
 app.include_router(chat.router, prefix="/api")
 app.include_router(vector.router, prefix="/api")
 app.include_router(users.router, prefix="/api")
@@ -31,7 +37,18 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
+app.add_middleware(clients.OpenAISessionMiddleware)
+app.add_event_handler("startup", clients.startup)
+app.add_event_handler("startup", job_queue.start)
+app.add_event_handler("startup", lambda: compactor.start(clients.get_embeddings()))
+app.add_event_handler("startup", reclaimer.start)
+app.add_event_handler("shutdown", job_queue.stop)
+app.add_event_handler("shutdown", parsing.shutdown)
+app.add_event_handler("shutdown", compactor.stop)
+app.add_event_handler("shutdown", reclaimer.stop)
+app.add_event_handler("shutdown", clients.shutdown)
 
 
 @app.get("healthchecker")
@@ -8,6 +8,7 @@ from sqlalchemy import (
     Enum,
     Float,
     ForeignKey,
+    Index,
     Integer,
     String,
     Text,
@@ -75,6 +76,8 @@ class Chat(Base, AuditMixin):
     )
     user = relationship("User")
 
+    __table_args__ = (Index("ix_chats_user_id_updated_at", "user_id", "updated_at"),)
+
 
 class MessageType(str, PythonEnum):
     QUESTION = "question"
@@ -104,6 +107,10 @@ class ChatMessage(Base, AuditMixin):
     user = relationship("User")
     chat = relationship("Chat")
 
+    __table_args__ = (
+        Index("ix_chat_messages_chat_id_updated_at", "chat_id", "updated_at"),
+    )
+
 
 class UserTrainData(Base, AuditMixin):
     __tablename__ = "usertraindatas"
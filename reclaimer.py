@@ -0,0 +1,262 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+import uuid
+
+from config import settings
+from database import session
+from ingestion.jobs import FAILED, JOB_ROOT, QUEUED, RUNNING, load_job
+from models.users import Chat, User, UserTrainData
+from retrieval.segments import remove_index
+from storage import (
+    CHAT_ROOT,
+    INDEX_ROOT,
+    MEDIA_ROOT,
+    UPLOAD_ROOT,
+    USER_ROOTS,
+    remove_path,
+    storage_usage,
+    user_directories
+)
+
+logger = logging.getLogger(__name__)
+
+# Held while reclaiming so only one worker process sweeps the volumes at a time
+RECLAIM_LOCK_FILE = ".reclaim.lock"
+INDEX_DIR_SUFFIX = "_all_embeddings"
+DAY_SECONDS = 24 * 60 * 60
+
+
+def modified_at(path):
+    """Latest modification time of ``path`` and the entries directly inside it."""
+    latest = os.path.getmtime(path)
+    if os.path.isdir(path):
+        for entry in os.scandir(path):
+            try:
+                latest = max(latest, entry.stat().st_mtime)
+            except FileNotFoundError:
+                pass
+    return latest
+
+
+def _older_than(path, seconds, now):
+    try:
+        return now - modified_at(path) > seconds
+    except FileNotFoundError:
+        return False
+
+
+def customer_ids():
+    """Ids of every user with a directory under one of the storage roots."""
+    found = set()
+    for root in USER_ROOTS:
+        if not os.path.isdir(root):
+            continue
+        for name in os.listdir(root):
+            if is_customer_id(name):
+                found.add(name)
+    return found
+
+
+def is_customer_id(name):
+    try:
+        return str(uuid.UUID(name)) == name
+    except ValueError:
+        return False
+
+
+def job_records():
+    """``(record path, record)`` of every job in ``train_jobs``."""
+    if not os.path.isdir(JOB_ROOT):
+        return
+    for name in os.listdir(JOB_ROOT):
+        if not name.endswith(".json"):
+            continue
+        record = load_job(name[:-len(".json")])
+        if record is not None:
+            yield os.path.join(JOB_ROOT, name), record
+
+
+def active_data_ids():
+    """
+    Data ids of jobs that are queued, running or waiting for a retry.
+
+    Their segments are published before the ``UserTrainData`` row exists, and a
+    job can run longer than ``RECLAIM_GRACE_SECONDS``.
+    """
+    return {
+        str(record["data_id"])
+        for _, record in job_records()
+        if record["status"] in (QUEUED, RUNNING) or (record["status"] == FAILED and record.get("retryable"))
+    }
+
+
+def reclaim_user(db, customer_id, now, active=frozenset()):
+    """
+    Delete what ``customer_id`` no longer needs and return the bytes freed.
+
+    - everything, once the user no longer exists
+    - index directories whose ``UserTrainData`` row is gone, unless a job in
+      ``active`` is still writing them
+    - transcripts of deleted chats, and of any chat after ``TRANSCRIPT_RETENTION_DAYS``
+    - Gmail PDFs under ``media`` after ``MEDIA_RETENTION_DAYS``
+
+    Orphans are only removed once untouched for ``RECLAIM_GRACE_SECONDS``, so an
+    upload still being indexed (its row is created last) is never mistaken for one.
+    """
+    grace = settings.RECLAIM_GRACE_SECONDS
+    freed = 0
+    if db.query(User.id).filter(User.id == customer_id).first() is None:
+        for path in user_directories(customer_id):
+            if os.path.exists(path) and _older_than(path, grace, now):
+                freed += remove_path(customer_id, path)
+        return freed
+
+    index_folder = os.path.join(INDEX_ROOT, customer_id)
+    if os.path.isdir(index_folder):
+        data_ids = {
+            str(data_id)
+            for data_id, in db.query(UserTrainData.id).filter(UserTrainData.user_id == customer_id)
+        }
+        for name in os.listdir(index_folder):
+            path = os.path.join(index_folder, name)
+            if not name.endswith(INDEX_DIR_SUFFIX):
+                continue
+            data_id = name[:-len(INDEX_DIR_SUFFIX)]
+            if data_id in data_ids or data_id in active:
+                continue
+            if _older_than(path, grace, now):
+                size = remove_index(path)
+                storage_usage.add(customer_id, -size)
+                freed += size
+
+    transcript_folder = os.path.join(CHAT_ROOT, customer_id, "data")
+    if os.path.isdir(transcript_folder):
+        chat_ids = {str(chat_id) for chat_id, in db.query(Chat.id).filter(Chat.user_id == customer_id)}
+        for name in os.listdir(transcript_folder):
+            path = os.path.join(transcript_folder, name)
+            chat_id = name.split(".", 1)[0]
+            if chat_id not in chat_ids:
+                expired = _older_than(path, grace, now)
+            else:
+                retention = settings.TRANSCRIPT_RETENTION_DAYS
+                expired = retention is not None and _older_than(path, retention * DAY_SECONDS, now)
+            if expired:
+                freed += remove_path(customer_id, path)
+
+    media_folder = os.path.join(MEDIA_ROOT, customer_id)
+    if os.path.isdir(media_folder):
+        for name in os.listdir(media_folder):
+            path = os.path.join(media_folder, name)
+            if _older_than(path, settings.MEDIA_RETENTION_DAYS * DAY_SECONDS, now):
+                freed += remove_path(customer_id, path)
+    return freed
+
+
+def reclaim_jobs(now):
+    """
+    Delete job records, with their upload workspaces, once untouched for
+    ``JOB_RETENTION_DAYS``, and workspaces no job record refers to; returns the
+    bytes freed.
+
+    A running job saves its record every few seconds, so only finished jobs,
+    failed ones nobody retried, and jobs lost to a restart get that old.
+    """
+    freed = 0
+    live_workspaces = set()
+    for record_path, record in job_records():
+        if not _older_than(record_path, settings.JOB_RETENTION_DAYS * DAY_SECONDS, now):
+            live_workspaces.add(os.path.normpath(record["workspace"]))
+            continue
+        freed += remove_path(record["customer_id"], record["workspace"])
+        for path in (record_path, f"{record_path}.lock"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    if os.path.isdir(UPLOAD_ROOT):
+        for customer_id in os.listdir(UPLOAD_ROOT):
+            customer_folder = os.path.join(UPLOAD_ROOT, customer_id)
+            # Workspaces created before they were grouped by user sit directly in the root
+            workspaces = (
+                [os.path.join(customer_folder, name) for name in os.listdir(customer_folder)]
+                if is_customer_id(customer_id) else [customer_folder]
+            )
+            for path in workspaces:
+                if os.path.normpath(path) in live_workspaces:
+                    continue
+                if _older_than(path, settings.RECLAIM_GRACE_SECONDS, now):
+                    freed += remove_path(customer_id, path)
+    return freed
+
+
+def reclaim():
+    """Sweep the upload workspaces and every user's directories once; returns the bytes freed."""
+    now = time.time()
+    freed = reclaim_jobs(now)
+    active = active_data_ids()
+    with session() as db:
+        for customer_id in customer_ids():
+            try:
+                freed += reclaim_user(db, customer_id, now, active)
+            except Exception:
+                logger.exception("Reclaiming storage of %s failed", customer_id)
+            storage_usage.measure(customer_id)
+    return freed
+
+
+class Reclaimer:
+    """
+    Background thread running ``reclaim`` every ``interval`` seconds.
+
+    Each pass also measures every user's usage again, correcting the incremental
+    counts of this process for files other processes wrote.
+    """
+
+    def __init__(self, interval: int):
+        self.interval = interval
+        self.last_run = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="storage-reclaimer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def run_once(self):
+        """Reclaim unless another process is already doing so; returns the bytes freed."""
+        os.makedirs(INDEX_ROOT, exist_ok=True)
+        with open(os.path.join(INDEX_ROOT, RECLAIM_LOCK_FILE), "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+            try:
+                started = time.time()
+                freed = reclaim()
+                self.last_run = {"started_at": started, "seconds": time.time() - started, "bytes_freed": freed}
+                if freed:
+                    logger.info("Reclaimed %d bytes of storage", freed)
+                return freed
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Reclaiming storage failed")
+
+
+reclaimer = Reclaimer(interval=settings.RECLAIM_INTERVAL_SECONDS)
@@ -0,0 +1,122 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from config import settings
+
+
+def normalize_question(question):
+    return " ".join(question.lower().split()).rstrip("?!. ")
+
+
+def chunk_id(doc):
+    return hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest()
+
+
+def prompt_version(prompt, llm):
+    """Identify everything besides the question and context that shapes an answer."""
+    source = f"{prompt.template}|{llm.model_name}|{llm.temperature}|{llm.max_tokens}"
+    return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    """
+    LRU cache of generated answers with a time-to-live.
+
+    Answers are keyed on the normalized question, the ids of the retrieved chunks (in
+    prompt order) and the prompt/model version. When ``similarity_threshold`` is set,
+    a miss on the exact question falls back to the closest cached question asked over
+    the same chunks, if the cosine similarity of the query embeddings reaches the
+    threshold.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: int, similarity_threshold=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict()
+        self._by_context = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    def get(self, question, docs, version, query_embedding=None):
+        context_key = (tuple(chunk_id(doc) for doc in docs), version)
+        key = (normalize_question(question), context_key)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._discard(key)
+
+            if self.similarity_threshold is not None and query_embedding is not None:
+                key = self._most_similar(context_key, query_embedding, now)
+                if key is not None:
+                    self._entries.move_to_end(key)
+                    self.similar_hits += 1
+                    return self._entries[key][1]
+            self.misses += 1
+            return None
+
+    def put(self, question, docs, version, answer, query_embedding=None):
+        context_key = (tuple(chunk_id(doc) for doc in docs), version)
+        key = (normalize_question(question), context_key)
+        vector = None
+        if query_embedding is not None:
+            vector = np.asarray(query_embedding, dtype=np.float32)
+            vector /= np.linalg.norm(vector) or 1.0
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, answer, vector)
+            self._by_context.setdefault(context_key, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._discard(next(iter(self._entries)))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "similar_hits": self.similar_hits,
+                "misses": self.misses,
+            }
+
+    def _most_similar(self, context_key, query_embedding, now):
+        keys = [
+            key
+            for key in self._by_context.get(context_key, ())
+            if self._entries[key][0] > now and self._entries[key][2] is not None
+        ]
+        if not keys:
+            return None
+        vector = np.asarray(query_embedding, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        similarities = np.stack([self._entries[key][2] for key in keys]) @ vector
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            return None
+        return keys[best]
+
+    def _discard(self, key):
+        if self._entries.pop(key, None) is None:
+            return
+        keys = self._by_context[key[1]]
+        keys.discard(key)
+        if not keys:
+            del self._by_context[key[1]]
+
+
+answer_cache = AnswerCache(
+    max_entries=settings.ANSWER_CACHE_MAX_ENTRIES,
+    ttl_seconds=settings.ANSWER_CACHE_TTL_SECONDS,
+    similarity_threshold=settings.ANSWER_CACHE_SIMILARITY_THRESHOLD,
+)
@@ -0,0 +1,113 @@
+"""
+Recall vs. latency benchmark for the index types in ``retrieval.index_types``.
+
+Builds every index type over the same vectors, searches them with held-out
+queries and compares the hits against exact (flat) search, to pick
+``INDEX_SQ8_MIN_VECTORS``, ``INDEX_IVFPQ_MIN_VECTORS`` and ``INDEX_IVF_NPROBE``.
+
+    python -m retrieval.benchmark --vectors 200000 --dimension 1536
+    python -m retrieval.benchmark --index trained_db/<customer_id>/consolidated_embeddings/segments/<name>
+"""
+import argparse
+import time
+
+import faiss
+import numpy as np
+
+from retrieval.index_types import FLAT, FP16, INDEX_TYPES, IVFPQ, SQ8, build_index
+
+
+def synthetic_vectors(count, dimension, clusters=256, seed=0):
+    """Clustered unit vectors, closer to real embeddings than uniform noise."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimension)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, count)]
+    vectors += 0.3 * rng.standard_normal((count, dimension)).astype(np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def load_vectors(folder_path):
+    index = faiss.read_index(f"{folder_path}/index.faiss")
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def recall_at_k(found, expected):
+    hits = sum(len(set(row[row != -1]) & set(truth)) for row, truth in zip(found, expected))
+    return hits / expected.size
+
+
+def measure(index, queries, k, params=None):
+    latencies = []
+    results = []
+    for query in queries:
+        started = time.perf_counter()
+        if params is None:
+            _, ids = index.search(query[None, :], k)
+        else:
+            _, ids = index.search(query[None, :], k, params=params)
+        latencies.append(time.perf_counter() - started)
+        results.append(ids[0])
+    return np.array(results), np.array(latencies) * 1000
+
+
+def run(vectors, queries, k, index_types, nprobes):
+    truth_index = build_index(vectors, FLAT)
+    _, truth = truth_index.search(queries, k)
+    rows = []
+    for index_type in index_types:
+        started = time.perf_counter()
+        index = build_index(vectors, index_type)
+        build_seconds = time.perf_counter() - started
+        size = len(faiss.serialize_index(index))
+        settings_to_try = [(None, None)]
+        if index_type == IVFPQ:
+            settings_to_try = []
+            for nprobe in nprobes:
+                params = faiss.SearchParametersIVF()
+                params.nprobe = nprobe
+                settings_to_try.append((nprobe, params))
+        for nprobe, params in settings_to_try:
+            found, latencies = measure(index, queries, k, params)
+            rows.append({
+                "type": index_type if nprobe is None else f"{index_type} nprobe={nprobe}",
+                "bytes": size,
+                "build_s": build_seconds,
+                "recall": recall_at_k(found, truth),
+                "p50_ms": float(np.percentile(latencies, 50)),
+                "p95_ms": float(np.percentile(latencies, 95)),
+            })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--index", help="Benchmark the vectors of a saved FAISS index directory")
+    parser.add_argument("--vectors", type=int, default=100000)
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=20)
+    parser.add_argument("--types", nargs="+", default=[FLAT, FP16, SQ8, IVFPQ], choices=INDEX_TYPES)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[8, 16, 32, 64])
+    args = parser.parse_args()
+
+    if args.index:
+        vectors = load_vectors(args.index)
+        rng = np.random.default_rng(1)
+        queries = vectors[rng.choice(len(vectors), args.queries, replace=False)]
+        queries = queries + 0.05 * rng.standard_normal(queries.shape).astype(np.float32)
+    else:
+        vectors = synthetic_vectors(args.vectors + args.queries, args.dimension)
+        vectors, queries = vectors[:args.vectors], vectors[args.vectors:]
+
+    print(f"{len(vectors)} vectors x {vectors.shape[1]} dimensions, {len(queries)} queries, recall@{args.k}")
+    print(f"{'type':<22}{'size MiB':>10}{'build s':>10}{'recall':>9}{'p50 ms':>9}{'p95 ms':>9}")
+    for row in run(vectors, queries, args.k, args.types, args.nprobe):
+        print(
+            f"{row['type']:<22}{row['bytes'] / 2 ** 20:>10.1f}{row['build_s']:>10.1f}"
+            f"{row['recall']:>9.3f}{row['p50_ms']:>9.2f}{row['p95_ms']:>9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
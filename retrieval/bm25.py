@@ -0,0 +1,160 @@
+import os
+import re
+from collections import Counter
+
+import numpy as np
+
+from retrieval.index_cache import index_cache
+
+LEXICAL_INDEX_FILE = "bm25.npz"
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class LexicalIndex:
+    """
+    Okapi BM25 inverted index over the chunks of one FAISS store.
+
+    Postings are kept in CSR form (``indptr`` into ``positions``/``term_counts``), where
+    a position is the chunk's position in the FAISS index, and saved as ``bm25.npz``
+    next to ``index.faiss``. ``docstore_ids`` records which chunk each position held
+    when the index was built, so hits can be checked against the store they are
+    resolved in.
+    """
+
+    def __init__(self, vocabulary, indptr, positions, term_counts, doc_lengths, docstore_ids, k1=1.5, b=0.75):
+        self.vocabulary = vocabulary
+        self.indptr = indptr
+        self.positions = positions
+        self.term_counts = term_counts
+        self.doc_lengths = doc_lengths
+        self.docstore_ids = docstore_ids
+        self.k1 = k1
+        self.b = b
+        self.average_length = doc_lengths.mean() if len(doc_lengths) else 0.0
+
+    @classmethod
+    def from_store(cls, store):
+        docstore_ids = [
+            store.index_to_docstore_id[position]
+            for position in range(len(store.index_to_docstore_id))
+        ]
+        postings = {}
+        doc_lengths = np.zeros(len(docstore_ids), dtype=np.int32)
+        for position, docstore_id in enumerate(docstore_ids):
+            tokens = tokenize(store.docstore.search(docstore_id).page_content)
+            doc_lengths[position] = len(tokens)
+            for term, count in Counter(tokens).items():
+                postings.setdefault(term, []).append((position, count))
+
+        terms = sorted(postings)
+        indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(postings[term]) for term in terms])
+        entries = [entry for term in terms for entry in postings[term]]
+        positions = np.array([position for position, _ in entries], dtype=np.int32)
+        term_counts = np.array([count for _, count in entries], dtype=np.int32)
+        vocabulary = {term: i for i, term in enumerate(terms)}
+        return cls(vocabulary, indptr, positions, term_counts, doc_lengths, np.array(docstore_ids, dtype=str))
+
+    def save(self, folder_path):
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        temp_path = os.path.join(folder_path, f"tmp_{LEXICAL_INDEX_FILE}")
+        np.savez_compressed(
+            temp_path,
+            terms=np.array(terms, dtype=str),
+            indptr=self.indptr,
+            positions=self.positions,
+            term_counts=self.term_counts,
+            doc_lengths=self.doc_lengths,
+            docstore_ids=self.docstore_ids,
+        )
+        os.replace(temp_path, os.path.join(folder_path, LEXICAL_INDEX_FILE))
+
+    @classmethod
+    def load(cls, folder_path, embeddings=None):
+        with np.load(os.path.join(folder_path, LEXICAL_INDEX_FILE)) as data:
+            vocabulary = {term: i for i, term in enumerate(data["terms"].tolist())}
+            return cls(
+                vocabulary,
+                data["indptr"],
+                data["positions"],
+                data["term_counts"],
+                data["doc_lengths"],
+                data["docstore_ids"],
+            )
+
+    def search(self, query, k, mask=None):
+        """
+        Return the BM25 scores and positions of the ``k`` best matching chunks.
+
+        Args:
+            query (str): Raw query text.
+            k (int): Number of hits to return.
+            mask (numpy.ndarray, optional): Boolean mask of positions allowed to match.
+        """
+        scores = np.zeros(len(self.doc_lengths), dtype=np.float32)
+        total = len(self.doc_lengths)
+        length_norm = self.k1 * (1 - self.b + self.b * self.doc_lengths / (self.average_length or 1.0))
+        for term in set(tokenize(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            positions = self.positions[start:end]
+            counts = self.term_counts[start:end]
+            idf = np.log(1 + (total - len(positions) + 0.5) / (len(positions) + 0.5))
+            scores[positions] += idf * counts * (self.k1 + 1) / (counts + length_norm[positions])
+
+        if mask is not None:
+            scores[~mask[: len(scores)]] = 0
+        candidates = np.flatnonzero(scores)
+        top = candidates[np.argsort(-scores[candidates], kind="stable")[:k]]
+        return scores[top], top
+
+
+def load_lexical_index(folder_path):
+    if not os.path.exists(os.path.join(folder_path, LEXICAL_INDEX_FILE)):
+        return None
+    return index_cache.get(folder_path, None, loader=LexicalIndex.load, files=(LEXICAL_INDEX_FILE,))
+
+
+def lexical_hits(indexes, lexical_indexes, query, k, masks=None):
+    """
+    Return the top ``k`` BM25 hits across several stores as (store number, position,
+    score) tuples, best first, skipping hits whose chunk moved since the lexical index
+    was built. ``masks`` optionally restricts each store to a boolean mask of positions.
+    """
+    scores, hits = [], []
+    for owner, (store, lexical_index) in enumerate(zip(indexes, lexical_indexes)):
+        if lexical_index is None:
+            continue
+        mask = None if masks is None else masks[owner]
+        store_scores, positions = lexical_index.search(query, k, mask)
+        for score, position in zip(store_scores, positions):
+            position = int(position)
+            if store.index_to_docstore_id.get(position) != lexical_index.docstore_ids[position]:
+                continue
+            scores.append(score)
+            hits.append((owner, position, float(score)))
+    order = np.argsort(-np.array(scores, dtype=np.float32), kind="stable")[:k]
+    return [hits[i] for i in order]
+
+
+def reciprocal_rank_fusion(rankings, k, rrf_k=60):
+    """
+    Fuse several best-first lists of (store number, position, score) hits.
+
+    Each hit scores ``sum(1 / (rrf_k + rank))`` over the lists it appears in, and the
+    top ``k`` are returned with that fused score.
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, (owner, position, _) in enumerate(ranking, start=1):
+            key = (owner, position)
+            fused[key] = fused.get(key, 0.0) + 1.0 / (rrf_k + rank)
+    ordered = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:k]
+    return [(owner, position, score) for (owner, position), score in ordered]
@@ -0,0 +1,119 @@
+import json
+import mmap
+import os
+from collections.abc import Mapping
+
+import faiss
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.vectorstores import FAISS
+
+CHUNKS_FILE = "chunks.jsonl"
+CHUNK_OFFSETS_FILE = "chunk_offsets.npy"
+CHUNK_IDS_FILE = "chunk_ids.npy"
+SORTED_CHUNK_IDS_FILE = "chunk_ids_sorted.npy"
+CHUNK_ID_ORDER_FILE = "chunk_id_order.npy"
+# What the index cache checks and weighs an mmapped store by: the memory-mapped
+# files live in the shared page cache, the offsets track what each worker holds privately
+MMAP_FILES = (CHUNK_OFFSETS_FILE,)
+
+
+def has_chunk_store(folder_path):
+    return os.path.exists(os.path.join(folder_path, CHUNK_OFFSETS_FILE))
+
+
+def write_chunk_store(folder_path, store):
+    """
+    Write the chunks of ``store`` as a random-access side store next to its index.
+
+    ``chunks.jsonl`` holds one JSON record per index position and
+    ``chunk_offsets.npy`` where each starts; the docstore ids are saved by position
+    and sorted, so both lookups work on memory-mapped arrays without unpickling.
+    """
+    count = store.index.ntotal
+    ids = [store.index_to_docstore_id[position] for position in range(count)]
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    with open(os.path.join(folder_path, CHUNKS_FILE), "wb") as chunks:
+        for position, docstore_id in enumerate(ids):
+            doc = store.docstore.search(docstore_id)
+            record = json.dumps({"page_content": doc.page_content, "metadata": doc.metadata})
+            chunks.write(record.encode("utf-8") + b"\n")
+            offsets[position + 1] = chunks.tell()
+    ids = np.array(ids, dtype=str)
+    order = np.argsort(ids, kind="stable")
+    np.save(os.path.join(folder_path, CHUNK_IDS_FILE), ids)
+    np.save(os.path.join(folder_path, SORTED_CHUNK_IDS_FILE), ids[order])
+    np.save(os.path.join(folder_path, CHUNK_ID_ORDER_FILE), order)
+    np.save(os.path.join(folder_path, CHUNK_OFFSETS_FILE), offsets)
+
+
+def _load_array(folder_path, name):
+    return np.load(os.path.join(folder_path, name), mmap_mode="r")
+
+
+class ChunkIds(Mapping):
+    """Read-only ``index_to_docstore_id`` backed by a memory-mapped array of ids."""
+
+    def __init__(self, ids):
+        self.ids = ids
+
+    def __getitem__(self, position):
+        if not 0 <= position < len(self.ids):
+            raise KeyError(position)
+        return str(self.ids[position])
+
+    def __iter__(self):
+        return iter(range(len(self.ids)))
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class ChunkDocstore:
+    """Read-only docstore that reads chunks from ``chunks.jsonl`` on demand."""
+
+    def __init__(self, folder_path):
+        self.offsets = _load_array(folder_path, CHUNK_OFFSETS_FILE)
+        self.ids = _load_array(folder_path, CHUNK_IDS_FILE)
+        self.sorted_ids = _load_array(folder_path, SORTED_CHUNK_IDS_FILE)
+        self.order = _load_array(folder_path, CHUNK_ID_ORDER_FILE)
+        with open(os.path.join(folder_path, CHUNKS_FILE), "rb") as chunks:
+            self._chunks = mmap.mmap(chunks.fileno(), 0, access=mmap.ACCESS_READ) if self.offsets[-1] else b""
+
+    def position(self, docstore_id):
+        i = int(np.searchsorted(self.sorted_ids, docstore_id))
+        if i < len(self.sorted_ids) and self.sorted_ids[i] == docstore_id:
+            return int(self.order[i])
+        return None
+
+    def get(self, position):
+        record = json.loads(self._chunks[self.offsets[position]:self.offsets[position + 1]])
+        return Document(page_content=record["page_content"], metadata=record["metadata"])
+
+    def search(self, search):
+        position = self.position(search)
+        if position is None:
+            return f"ID {search} not found."
+        return self.get(position)
+
+    def add(self, texts):
+        raise NotImplementedError("Memory-mapped segments are read-only")
+
+    def delete(self, ids):
+        raise NotImplementedError("Memory-mapped segments are read-only")
+
+
+def load_mmap_store(folder_path, embeddings):
+    """
+    Open a saved segment without reading it into memory.
+
+    The FAISS index is opened with ``IO_FLAG_MMAP``, which maps the inverted lists of
+    IVF indexes (segments are written in that layout when ``INDEX_MMAP`` is on), and
+    chunks come from the side store. Pages are shared between worker processes
+    through the OS page cache and opening costs the same for any index size.
+    """
+    index = faiss.read_index(
+        os.path.join(folder_path, "index.faiss"), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    )
+    docstore = ChunkDocstore(folder_path)
+    return FAISS(embeddings, index, docstore, ChunkIds(docstore.ids))
@@ -0,0 +1,135 @@
+import uuid
+
+import faiss
+import numpy as np
+
+from retrieval.chunk_store import ChunkIds
+from retrieval.index_types import build_store
+from retrieval.search import get_document, search_store
+from retrieval.segments import append_segment, load_segments, load_store, merge_stores, rewrite_segments, segment_path
+
+
+def consolidated_index_path(customer_id):
+    return f"trained_db/{customer_id}/consolidated_embeddings"
+
+
+class ConsolidatedSegment:
+    """
+    One segment of a consolidated index, with the owner of every vector decoded.
+
+    Each docstore id is prefixed with the ``UserTrainData.id`` it came from
+    (``"{data_id}:{chunk_id}"``), so the owner of every vector can be recovered from
+    the saved index alone.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        if isinstance(store.index_to_docstore_id, ChunkIds):
+            owners = np.char.partition(np.asarray(store.index_to_docstore_id.ids), ":")[:, 0]
+        else:
+            owners = np.array([
+                store.index_to_docstore_id[position].split(":", 1)[0]
+                for position in range(len(store.index_to_docstore_id))
+            ], dtype=str)
+        self.data_ids, self.owner_codes = np.unique(owners, return_inverse=True)
+
+    @classmethod
+    def load(cls, folder_path, embeddings):
+        return cls(load_store(folder_path, embeddings))
+
+    def mask(self, data_ids):
+        """Boolean mask over index positions selecting the chunks of ``data_ids``."""
+        codes = np.flatnonzero(np.isin(self.data_ids, np.array(data_ids, dtype=str)))
+        return np.isin(self.owner_codes, codes)
+
+
+class ConsolidatedIndex:
+    """
+    The chunks of every document a user has trained, stored as segments.
+
+    Searches are restricted to the requested documents with a FAISS
+    ``IDSelectorBitmap`` per segment, so one search per segment covers any number of
+    selected documents.
+    """
+
+    def __init__(self, segments):
+        self.paths = [path for path, _ in segments]
+        self.segments = [segment for _, segment in segments]
+        self.stores = [segment.store for segment in self.segments]
+
+    def covers(self, data_ids):
+        known = np.concatenate([segment.data_ids for segment in self.segments])
+        return bool(np.isin(np.array(data_ids, dtype=str), known).all())
+
+    def masks(self, data_ids):
+        return [segment.mask(data_ids) for segment in self.segments]
+
+    def rank(self, query_embedding, data_ids, k=3):
+        """Return the top ``k`` hits as (segment number, position, score) tuples, best first."""
+        vector = np.asarray([query_embedding], dtype=np.float32)
+        scores, owners, positions = [], [], []
+        for owner, (segment, mask) in enumerate(zip(self.segments, self.masks(data_ids))):
+            if not mask.any():
+                continue
+            bitmap = np.packbits(mask, bitorder="little")
+            selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+            segment_scores, segment_positions = search_store(segment.store, vector, k, selector)
+            scores.append(segment_scores)
+            positions.append(segment_positions)
+            owners.append(np.full(len(segment_positions), owner))
+
+        if not scores:
+            return []
+        scores = np.concatenate(scores)
+        owners = np.concatenate(owners)
+        positions = np.concatenate(positions)
+        top = np.argsort(-scores, kind="stable")[:k]
+        return [(int(owners[i]), int(positions[i]), float(scores[i])) for i in top]
+
+
+def load_consolidated_index(customer_id, embeddings):
+    segments = load_segments(
+        consolidated_index_path(customer_id), embeddings, loader=ConsolidatedSegment.load
+    )
+    if not segments:
+        return None
+    return ConsolidatedIndex(segments)
+
+
+def add_to_consolidated_index(customer_id, data_id, new_vectordb, embeddings):
+    """
+    Append the vectors of a freshly trained document to the user's consolidated index
+    as a new segment; returns the segment path.
+    """
+    documents = [
+        get_document(new_vectordb, position)
+        for position in range(new_vectordb.index.ntotal)
+    ]
+    vectors = new_vectordb.index.reconstruct_n(0, new_vectordb.index.ntotal)
+    ids = [f"{data_id}:{uuid.uuid4()}" for _ in documents]
+    text_embeddings = [
+        (doc.page_content, vector) for doc, vector in zip(documents, vectors.tolist())
+    ]
+    metadatas = [doc.metadata for doc in documents]
+    store = build_store(text_embeddings, embeddings, metadatas=metadatas, ids=ids)
+    folder_path = consolidated_index_path(customer_id)
+    return segment_path(folder_path, append_segment(folder_path, store))
+
+
+def remove_from_consolidated_index(customer_id, data_id, embeddings):
+    """Rewrite only the segments holding chunks of ``data_id``."""
+    prefix = f"{data_id}:"
+
+    def without_document(store):
+        keep = [
+            position
+            for position in range(store.index.ntotal)
+            if not store.index_to_docstore_id[position].startswith(prefix)
+        ]
+        if len(keep) == store.index.ntotal:
+            return store
+        if not keep:
+            return None
+        return merge_stores([store], embeddings, positions=[keep])
+
+    rewrite_segments(consolidated_index_path(customer_id), embeddings, without_document)
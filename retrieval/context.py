@@ -0,0 +1,89 @@
+import numpy as np
+import tiktoken
+
+_encoding = None
+
+
+def get_encoding():
+    global _encoding
+    if _encoding is None:
+        _encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+    return _encoding
+
+
+def count_tokens(texts):
+    return np.array([len(tokens) for tokens in get_encoding().encode_batch(texts)])
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def select_within_budget(query_embedding, vectors, token_counts, token_budget, lambda_mult, relevance=None):
+    """
+    Greedy maximal marginal relevance over all candidates, limited by a token budget.
+
+    Query and pairwise cosine similarities are computed once as matrix products; each
+    step then picks the candidate with the best ``lambda_mult * relevance -
+    (1 - lambda_mult) * redundancy`` among those that still fit in the remaining
+    budget. Returns candidate positions in selection order. The most relevant
+    candidate is always returned, even when it alone exceeds the budget.
+
+    ``relevance`` replaces the query cosine similarity when the candidates were ranked
+    by something other than the query vector alone.
+    """
+    vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+    if relevance is None:
+        query = _normalize(np.asarray(query_embedding, dtype=np.float32))
+        query_similarity = vectors @ query
+    else:
+        query_similarity = np.asarray(relevance, dtype=np.float32)
+    pairwise_similarity = vectors @ vectors.T
+
+    available = np.ones(len(vectors), dtype=bool)
+    redundancy = np.zeros(len(vectors), dtype=np.float32)
+    remaining = token_budget
+    selected = []
+    while True:
+        fits = available & (token_counts <= remaining)
+        if not fits.any():
+            break
+        scores = lambda_mult * query_similarity - (1 - lambda_mult) * redundancy
+        scores[~fits] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        remaining -= token_counts[best]
+        redundancy = np.maximum(redundancy, pairwise_similarity[best])
+
+    if not selected and len(vectors):
+        selected.append(int(np.argmax(query_similarity)))
+    return selected
+
+
+def build_context(candidates, query_embedding, token_budget, lambda_mult, rank_relevance=False):
+    """
+    Pick the chunks that go into the prompt.
+
+    Args:
+        candidates (list[tuple[Document, float, numpy.ndarray]]): Retrieved chunks
+            with their relevance score and embedding, already formatted for the prompt.
+        query_embedding (list[float]): Embedding of the query.
+        token_budget (int): Maximum number of context tokens to fill.
+        lambda_mult (float): 1 ranks by relevance only, 0 by diversity only.
+        rank_relevance (bool): Take relevance from the candidates' scores, scaled to
+            [0, 1], instead of their cosine similarity to the query.
+    """
+    if not candidates:
+        return []
+    docs, scores, vectors = zip(*candidates)
+    relevance = None
+    if rank_relevance:
+        relevance = np.asarray(scores, dtype=np.float32) / max(scores)
+    token_counts = count_tokens([doc.page_content for doc in docs])
+    selected = select_within_budget(
+        query_embedding, np.stack(vectors), token_counts, token_budget, lambda_mult, relevance
+    )
+    return [docs[i] for i in selected]
@@ -0,0 +1,99 @@
+import os
+import threading
+from collections import OrderedDict
+
+from langchain.vectorstores import FAISS
+
+from config import settings
+
+INDEX_FILES = ("index.faiss", "index.pkl")
+
+
+def index_signature(folder_path, files=INDEX_FILES):
+    """Return the (mtime, size) of the files backing a saved FAISS index."""
+    signature = []
+    for name in files:
+        stat = os.stat(os.path.join(folder_path, name))
+        signature.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+class IndexCache:
+    """
+    Bounded, process-wide LRU cache of loaded FAISS indexes.
+
+    Entries are keyed by the index directory (``trained_db/{customer_id}/{data_id}_all_embeddings``)
+    and the files loaded from it, and weighed by the size of those files, which tracks the
+    memory held by the vectors and the unpickled docstore. An entry is reloaded when
+    the files on disk change, so an index rewritten by ``/train`` in another worker
+    is never served stale.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, folder_path, embeddings, loader=FAISS.load_local, files=INDEX_FILES):
+        folder_path = os.path.normpath(folder_path)
+        key = (folder_path, files)
+        signature = index_signature(folder_path, files)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        index = loader(folder_path, embeddings)
+        size = sum(file_size for _, file_size in signature)
+
+        with self._lock:
+            self._discard(key)
+            if size <= self.max_bytes:
+                self._entries[key] = (signature, size, index)
+                self.current_bytes += size
+                while self.current_bytes > self.max_bytes:
+                    _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                    self.current_bytes -= evicted_size
+                    self.evictions += 1
+        return index
+
+    def invalidate(self, folder_path):
+        """Drop every entry loaded from ``folder_path`` or a directory inside it."""
+        folder_path = os.path.normpath(folder_path)
+        prefix = folder_path + os.sep
+        with self._lock:
+            for key in [
+                key for key in self._entries if key[0] == folder_path or key[0].startswith(prefix)
+            ]:
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry[1]
+
+
+index_cache = IndexCache(max_bytes=settings.INDEX_CACHE_MAX_BYTES)
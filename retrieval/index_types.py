@@ -0,0 +1,148 @@
+import math
+
+import faiss
+import numpy as np
+from langchain.vectorstores import FAISS
+
+from config import settings
+
+FLAT = "flat"
+FP16 = "fp16"
+SQ8 = "sq8"
+IVFPQ = "ivfpq"
+INDEX_TYPES = (FLAT, FP16, SQ8, IVFPQ)
+
+# k-means wants roughly this many training points per IVF list
+TRAINING_POINTS_PER_LIST = 64
+# PQ trains 256 centroids per sub-quantizer, so it cannot train on fewer vectors
+PQ_MIN_TRAINING_VECTORS = 256
+
+
+def trainable_type(index_type, count):
+    """``index_type``, or SQ8 when there are too few vectors to train IVF-PQ on."""
+    if index_type == IVFPQ and count < PQ_MIN_TRAINING_VECTORS:
+        return SQ8
+    return index_type
+
+
+def choose_index_type(count):
+    """Pick the index type for ``count`` vectors from ``INDEX_TYPE`` and the size thresholds."""
+    if settings.INDEX_TYPE != "auto":
+        return trainable_type(settings.INDEX_TYPE, count)
+    if count >= settings.INDEX_IVFPQ_MIN_VECTORS:
+        return trainable_type(IVFPQ, count)
+    if count >= settings.INDEX_SQ8_MIN_VECTORS:
+        return SQ8
+    return FLAT
+
+
+def pq_subquantizers(dimension):
+    """Largest number of PQ sub-quantizers up to ``dimension / 8`` that divides the dimension."""
+    if settings.INDEX_PQ_SUBQUANTIZERS:
+        return settings.INDEX_PQ_SUBQUANTIZERS
+    m = max(1, dimension // 8)
+    while dimension % m:
+        m -= 1
+    return m
+
+
+def factory_string(index_type, count, dimension):
+    # With INDEX_MMAP, non-IVF types become a single-list IVF so the codes can be mapped
+    prefix = "IVF1," if settings.INDEX_MMAP else ""
+    if index_type == FLAT:
+        return f"{prefix}Flat"
+    if index_type == FP16:
+        return f"{prefix}SQfp16"
+    if index_type == SQ8:
+        return f"{prefix}SQ8"
+    if index_type == IVFPQ:
+        nlist = max(1, min(int(4 * math.sqrt(count)), count // TRAINING_POINTS_PER_LIST))
+        return f"IVF{nlist},PQ{pq_subquantizers(dimension)}"
+    raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+
+
+def build_index(vectors, index_type=None, metric=faiss.METRIC_L2):
+    """
+    Build a FAISS index of ``index_type`` over ``vectors`` (an ``(n, d)`` float32 array).
+
+    Quantized and IVF indexes are trained on a sample of the vectors first. IVF indexes get
+    a direct map so ``reconstruct`` keeps working for context selection and
+    compaction.
+    """
+    count, dimension = vectors.shape
+    index_type = trainable_type(index_type, count) if index_type else choose_index_type(count)
+    index = faiss.index_factory(dimension, factory_string(index_type, count, dimension), metric)
+    if not index.is_trained:
+        sample = vectors
+        if index_type == IVFPQ:
+            nlist = faiss.extract_index_ivf(index).nlist
+            size = min(count, nlist * TRAINING_POINTS_PER_LIST)
+            sample = vectors[np.random.default_rng(0).choice(count, size, replace=False)]
+        index.train(sample)
+    index.add(vectors)
+    if isinstance(index, faiss.IndexIVF) or index_type == IVFPQ:
+        faiss.extract_index_ivf(index).make_direct_map()
+    return index
+
+
+def compress_store(store, index_type=None):
+    """Swap the flat index of ``store`` for the index type its vector count calls for."""
+    count = store.index.ntotal
+    index_type = index_type or choose_index_type(count)
+    if (index_type == FLAT and not settings.INDEX_MMAP) or count == 0:
+        return store
+    vectors = store.index.reconstruct_n(0, count)
+    metric = faiss.METRIC_INNER_PRODUCT if store.index.metric_type == faiss.METRIC_INNER_PRODUCT else faiss.METRIC_L2
+    store.index = build_index(vectors, index_type, metric)
+    return store
+
+
+def build_store(text_embeddings, embeddings, metadatas=None, ids=None):
+    """``FAISS.from_embeddings`` with the index type chosen by vector count."""
+    store = FAISS.from_embeddings(text_embeddings, embeddings, metadatas=metadatas, ids=ids)
+    return compress_store(store)
+
+
+def to_mmap_layout(index):
+    """
+    Return ``index`` in a layout faiss can memory-map.
+
+    faiss only maps the inverted lists of IVF indexes, so flat and scalar quantizer
+    indexes are rewritten as a single-list IVF whose one centroid is the origin:
+    every vector lands in that list unchanged and a search scans it exactly like
+    the original index did. ``build_index`` already produces this layout when
+    ``INDEX_MMAP`` is on; this converts stores built any other way.
+    """
+    # Keep the original wrapper: it owns the index, the downcast one does not
+    concrete = faiss.downcast_index(index)
+    if isinstance(concrete, faiss.IndexIVF):
+        return index
+    dimension, metric = index.d, index.metric_type
+    vectors = index.reconstruct_n(0, index.ntotal)
+    quantizer = faiss.IndexFlat(dimension, metric)
+    quantizer.add(np.zeros((1, dimension), dtype=np.float32))
+    if isinstance(concrete, faiss.IndexScalarQuantizer):
+        ivf = faiss.IndexIVFScalarQuantizer(quantizer, dimension, 1, concrete.sq.qtype, metric)
+    else:
+        ivf = faiss.IndexIVFFlat(quantizer, dimension, 1, metric)
+    ivf.train(vectors)
+    ivf.add(vectors)
+    ivf.make_direct_map()
+    return ivf
+
+
+def search_parameters(index, selector=None):
+    """
+    Search parameters for ``index``: the configured ``nprobe`` for IVF indexes, and
+    ``selector`` restricting which ids may match. ``None`` when defaults apply.
+    """
+    if isinstance(faiss.downcast_index(index), faiss.IndexIVF):
+        params = faiss.SearchParametersIVF()
+        params.nprobe = settings.INDEX_IVF_NPROBE
+    elif selector is not None:
+        params = faiss.SearchParameters()
+    else:
+        return None
+    if selector is not None:
+        params.sel = selector
+    return params
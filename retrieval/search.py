@@ -0,0 +1,78 @@
+import faiss
+import numpy as np
+
+from retrieval.chunk_store import ChunkDocstore
+from retrieval.index_types import search_parameters
+
+
+def _relevance_scores(store, distances):
+    relevance_score_fn = np.vectorize(store._select_relevance_score_fn(), otypes=[np.float32])
+    return relevance_score_fn(distances)
+
+
+def search_store(store, vector, k, selector=None):
+    """
+    Search one FAISS store with an already embedded query.
+
+    Returns the relevance scores and index positions of the hits as NumPy arrays,
+    with the empty (-1) slots FAISS pads short result lists with removed.
+    ``selector`` optionally restricts the ids that may match.
+    """
+    if store._normalize_L2:
+        vector = vector.copy()
+        faiss.normalize_L2(vector)
+    params = search_parameters(store.index, selector)
+    if params is None:
+        distances, ids = store.index.search(vector, k)
+    else:
+        distances, ids = store.index.search(vector, k, params=params)
+    found = ids[0] != -1
+    return _relevance_scores(store, distances[0][found]), ids[0][found]
+
+
+def get_document(store, position):
+    if isinstance(store.docstore, ChunkDocstore):
+        return store.docstore.get(position)
+    return store.docstore.search(store.index_to_docstore_id[position])
+
+
+def rank_indexes(indexes, query_embedding, k=3):
+    """
+    Return the top ``k`` hits across several FAISS stores as (store number, position,
+    relevance score) tuples, best first.
+
+    The query is embedded once by the caller and the same vector is searched against
+    every index. Per-index hits are merged with a stable sort on the relevance scores,
+    which gives the same ordering as concatenating each store's
+    ``similarity_search_with_relevance_scores`` results and sorting them descending.
+    """
+    vector = np.asarray([query_embedding], dtype=np.float32)
+    scores, owners, positions = [], [], []
+    for owner, store in enumerate(indexes):
+        store_scores, store_positions = search_store(store, vector, k)
+        scores.append(store_scores)
+        positions.append(store_positions)
+        owners.append(np.full(len(store_positions), owner))
+
+    if not scores:
+        return []
+    scores = np.concatenate(scores)
+    owners = np.concatenate(owners)
+    positions = np.concatenate(positions)
+    top = np.argsort(-scores, kind="stable")[:k]
+    return [(int(owners[i]), int(positions[i]), float(scores[i])) for i in top]
+
+
+def materialize_hits(indexes, hits, return_vectors=False):
+    """Turn (store number, position, score) hits into (document, score[, vector]) tuples."""
+    if return_vectors:
+        return [
+            (
+                get_document(indexes[owner], position),
+                score,
+                indexes[owner].index.reconstruct(position),
+            )
+            for owner, position, score in hits
+        ]
+    return [(get_document(indexes[owner], position), score) for owner, position, score in hits]
+
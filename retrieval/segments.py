@@ -0,0 +1,321 @@
+import fcntl
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+from langchain.vectorstores import FAISS
+
+from config import settings
+from retrieval.bm25 import LexicalIndex
+from retrieval.chunk_store import MMAP_FILES, has_chunk_store, load_mmap_store, write_chunk_store
+from retrieval.index_cache import INDEX_FILES, index_cache
+from retrieval.index_types import build_store, to_mmap_layout
+from retrieval.search import get_document
+from storage import path_size
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+SEGMENTS_DIR = "segments"
+WRITE_LOCK_FILE = ".write.lock"
+READ_LOCK_FILE = ".read.lock"
+# A directory written before segments existed is read as a single segment
+LEGACY_SEGMENT = "."
+
+
+def _manifest_path(folder_path):
+    return os.path.join(folder_path, MANIFEST_FILE)
+
+
+def read_manifest(folder_path):
+    """Return the names of the live segments of an index directory, oldest first."""
+    try:
+        with open(_manifest_path(folder_path)) as manifest:
+            return json.load(manifest)["segments"]
+    except FileNotFoundError:
+        if os.path.exists(os.path.join(folder_path, "index.faiss")):
+            return [LEGACY_SEGMENT]
+        return []
+
+
+def write_manifest(folder_path, segments):
+    """Atomically replace the manifest; readers see either the old or the new segment list."""
+    path = _manifest_path(folder_path)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, "w") as manifest:
+        json.dump({"segments": segments, "updated_at": time.time()}, manifest)
+        manifest.flush()
+        os.fsync(manifest.fileno())
+    os.replace(temp_path, path)
+
+
+def segment_path(folder_path, name):
+    if name == LEGACY_SEGMENT:
+        return os.path.normpath(folder_path)
+    return os.path.normpath(os.path.join(folder_path, SEGMENTS_DIR, name))
+
+
+def segment_paths(folder_path):
+    return [segment_path(folder_path, name) for name in read_manifest(folder_path)]
+
+
+@contextmanager
+def _flock(path, operation):
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@contextmanager
+def write_lock(folder_path):
+    """Serialize manifest updates to one index directory across threads and processes."""
+    os.makedirs(folder_path, exist_ok=True)
+    with _flock(os.path.join(folder_path, WRITE_LOCK_FILE), fcntl.LOCK_EX):
+        yield
+
+
+@contextmanager
+def index_lock(folder_path, exclusive=False):
+    """
+    Reader/writer lock on an index directory, across threads and processes.
+
+    Loading segments holds it shared, deleting segments or the whole directory
+    holds it exclusively, so files are never removed from under a load. Appends
+    need neither: a segment is renamed into place complete and then published by
+    replacing the manifest.
+    """
+    if exclusive:
+        os.makedirs(folder_path, exist_ok=True)
+    with _flock(os.path.join(folder_path, READ_LOCK_FILE), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH):
+        yield
+
+
+def _cache_files(folder_path):
+    if settings.INDEX_MMAP and has_chunk_store(folder_path):
+        return MMAP_FILES
+    return INDEX_FILES
+
+
+def load_store(folder_path, embeddings):
+    """Load a segment memory-mapped when ``INDEX_MMAP`` is on and it was written for it."""
+    if settings.INDEX_MMAP and has_chunk_store(folder_path):
+        return load_mmap_store(folder_path, embeddings)
+    return FAISS.load_local(folder_path, embeddings)
+
+
+def load_segments(folder_path, embeddings, loader=load_store):
+    """
+    Return ``(segment path, loaded segment)`` pairs for the live segments of an index
+    directory, each loaded through the index cache.
+
+    Segments are immutable, so a cached segment never goes stale; only the manifest
+    changes. The manifest is read and its segments loaded under a shared
+    ``index_lock``, so compaction or a delete cannot remove them half way.
+    """
+    try:
+        with index_lock(folder_path):
+            return [
+                (path, index_cache.get(path, embeddings, loader=loader, files=_cache_files(path)))
+                for path in segment_paths(folder_path)
+            ]
+    except FileNotFoundError:
+        # The whole directory was deleted (or never written)
+        if os.path.isdir(folder_path):
+            raise
+        return []
+
+
+def write_segment(folder_path, store):
+    """Save ``store`` and its BM25 index as a new, not yet published, segment; returns its name."""
+    segments_dir = os.path.join(folder_path, SEGMENTS_DIR)
+    os.makedirs(segments_dir, exist_ok=True)
+    name = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+    temp_dir = os.path.join(segments_dir, f".tmp-{name}")
+    if settings.INDEX_MMAP:
+        store.index = to_mmap_layout(store.index)
+    store.save_local(temp_dir)
+    LexicalIndex.from_store(store).save(temp_dir)
+    if settings.INDEX_MMAP:
+        write_chunk_store(temp_dir, store)
+    os.rename(temp_dir, os.path.join(segments_dir, name))
+    return name
+
+
+def remove_segment(folder_path, name):
+    """Delete a segment no manifest refers to any more; call with ``index_lock`` held exclusively."""
+    path = segment_path(folder_path, name)
+    if name == LEGACY_SEGMENT:
+        for file_name in ("index.faiss", "index.pkl", "bm25.npz"):
+            try:
+                os.remove(os.path.join(path, file_name))
+            except FileNotFoundError:
+                pass
+    else:
+        shutil.rmtree(path, ignore_errors=True)
+    index_cache.invalidate(path)
+
+
+def append_segment(folder_path, store):
+    """Publish ``store`` as a new segment; the I/O is proportional to the new vectors only."""
+    name = write_segment(folder_path, store)
+    with write_lock(folder_path):
+        write_manifest(folder_path, read_manifest(folder_path) + [name])
+    compactor.request(folder_path)
+    return name
+
+
+def rewrite_segments(folder_path, embeddings, transform):
+    """
+    Replace segments through ``transform(store)``, which returns the store unchanged to
+    keep a segment, ``None`` to drop it, or a new store to replace it.
+    """
+    with write_lock(folder_path):
+        names = read_manifest(folder_path)
+        kept, retired = [], []
+        for name in names:
+            store = FAISS.load_local(segment_path(folder_path, name), embeddings)
+            new_store = transform(store)
+            if new_store is store:
+                kept.append(name)
+                continue
+            retired.append(name)
+            if new_store is not None and new_store.index.ntotal:
+                kept.append(write_segment(folder_path, new_store))
+        if retired:
+            write_manifest(folder_path, kept)
+    _remove_segments(folder_path, retired)
+
+
+def _remove_segments(folder_path, names):
+    if not names:
+        return
+    with index_lock(folder_path, exclusive=True):
+        for name in names:
+            remove_segment(folder_path, name)
+
+
+def remove_index(folder_path):
+    """Delete a whole index directory once no load is reading it; returns the bytes freed."""
+    if not os.path.isdir(folder_path):
+        return 0
+    with index_lock(folder_path, exclusive=True):
+        size = path_size(folder_path)
+        shutil.rmtree(folder_path, ignore_errors=True)
+    index_cache.invalidate(folder_path)
+    return size
+
+
+def _entries(store, positions):
+    documents = [get_document(store, position) for position in positions]
+    vectors = store.index.reconstruct_batch(np.asarray(positions, dtype=np.int64)) if positions else []
+    return (
+        [(doc.page_content, vector.tolist()) for doc, vector in zip(documents, vectors)],
+        [doc.metadata for doc in documents],
+        [store.index_to_docstore_id[position] for position in positions],
+    )
+
+
+def merge_stores(stores, embeddings, positions=None):
+    """
+    Build one new store from the vectors, documents and docstore ids of ``stores``.
+
+    ``positions`` optionally limits each store to the given index positions.
+    """
+    text_embeddings, metadatas, ids = [], [], []
+    for number, store in enumerate(stores):
+        selected = list(range(store.index.ntotal)) if positions is None else list(positions[number])
+        store_embeddings, store_metadatas, store_ids = _entries(store, selected)
+        text_embeddings.extend(store_embeddings)
+        metadatas.extend(store_metadatas)
+        ids.extend(store_ids)
+    return build_store(text_embeddings, embeddings, metadatas=metadatas, ids=ids)
+
+
+def compact(folder_path, embeddings):
+    """
+    Merge every segment of an index directory into one.
+
+    The merged segment is built from a snapshot of the manifest without holding the
+    write lock, so uploads keep appending meanwhile. The swap then happens under the
+    lock with a single manifest replace: segments appended since the snapshot are
+    kept, and if any snapshotted segment was rewritten in the meantime the merge is
+    abandoned. Retired segments are deleted once no manifest refers to them.
+    """
+    with index_lock(folder_path):
+        names = read_manifest(folder_path)
+        if len(names) < 2:
+            return False
+        stores = [FAISS.load_local(segment_path(folder_path, name), embeddings) for name in names]
+    merged_name = write_segment(folder_path, merge_stores(stores, embeddings))
+
+    with write_lock(folder_path):
+        current = read_manifest(folder_path)
+        swapped = all(name in current for name in names)
+        if swapped:
+            write_manifest(folder_path, [merged_name] + [name for name in current if name not in names])
+    if not swapped:
+        _remove_segments(folder_path, [merged_name])
+        return False
+    _remove_segments(folder_path, names)
+    return True
+
+
+class Compactor:
+    """
+    Background thread merging the segments of index directories that reached
+    ``threshold`` segments.
+    """
+
+    def __init__(self, threshold: int):
+        self.threshold = threshold
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.embeddings = None
+
+    def request(self, folder_path):
+        folder_path = os.path.normpath(folder_path)
+        if len(read_manifest(folder_path)) < self.threshold:
+            return
+        with self._lock:
+            if folder_path in self._pending:
+                return
+            self._pending.add(folder_path)
+        self._queue.put(folder_path)
+
+    def start(self, embeddings):
+        self.embeddings = embeddings
+        self._thread = threading.Thread(target=self._run, name="segment-compactor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            folder_path = self._queue.get()
+            if folder_path is None:
+                return
+            with self._lock:
+                self._pending.discard(folder_path)
+            try:
+                compact(folder_path, self.embeddings)
+            except Exception:
+                logger.exception("Compacting %s failed", folder_path)
+
+
+compactor = Compactor(threshold=settings.SEGMENT_COMPACTION_THRESHOLD)
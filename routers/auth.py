@@ -6,6 +6,7 @@ import pdfkit
 import requests
 from dotenv import load_dotenv
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from xhtml2pdf import pisa
 from sqlalchemy.orm import Session
 from fastapi.responses import FileResponse,JSONResponse
@@ -13,11 +14,14 @@ from fastapi.security import OAuth2PasswordBearer
 from fastapi_jwt_auth import AuthJWT
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
+from clients import get_http_session
 from database import get_db
 from fastapi.responses import RedirectResponse
+from gmail import fetch_messages, get_api_endpoint, list_message_ids
 from models.users import UserCreditHistory
 from models.schemas import Login, Refresh, Register, Token, User, UserResponse
 from services import add_user, get_user, update_access_token
+from storage import storage_usage
 from utils import generate_unique_uuid, get_email_body, get_email_from, get_email_subject, get_email_to, verify_password, get_email_date
 
 load_dotenv()
@@ -149,9 +153,8 @@ async def protected(email: str,db: Session = Depends(get_db), authorize: AuthJWT
             scopes=['https://www.googleapis.com/auth/gmail.readonly']
         )
 
-        service = build('gmail', 'v1', credentials=creds)
-        results = service.users().messages().list(userId='me', q=f"from:{email}").execute()
-        messages = results.get('messages', [])
+        service = build('gmail', 'v1', credentials=creds, client_options={"api_endpoint": f"{get_api_endpoint()}/"})
+        messages = await run_in_threadpool(list_message_ids, service, f"from:{email}")
     except:
         token_endpoint = 'https://oauth2.googleapis.com/token'
         params = {
@@ -171,9 +174,8 @@ async def protected(email: str,db: Session = Depends(get_db), authorize: AuthJWT
                 scopes=['https://www.googleapis.com/auth/gmail.readonly']
             )
 
-                service = build('gmail', 'v1', credentials=creds)
-                results = service.users().messages().list(userId='me', q=f"from:{email}").execute()
-                messages = results.get('messages', [])
+                service = build('gmail', 'v1', credentials=creds, client_options={"api_endpoint": f"{get_api_endpoint()}/"})
+                messages = await run_in_threadpool(list_message_ids, service, f"from:{email}")
             except:
                 raise HTTPException(status_code=400, detail="Token expired again connect google")   
         else:
@@ -183,8 +185,16 @@ async def protected(email: str,db: Session = Depends(get_db), authorize: AuthJWT
     if not messages:
         return {"message": 'No messages found.'}
     else:
-        for message in messages:
-            msg = service.users().messages().get(userId='me', id=message['id']).execute()
+        # Fetched concurrently; messages that keep failing are left out of the PDF
+        fetched, errors = await fetch_messages(creds.token, messages, session=get_http_session())
+        if errors and len(errors) == len(messages):
+            return JSONResponse(
+                content={"status": "error", "message": "Could not fetch your emails from Gmail, please try again"},
+                status_code=502,
+            )
+        for msg in fetched:
+            if msg is None:
+                continue
             subject = get_email_subject(msg)
             body = get_email_body(msg)
             email_from = get_email_from(msg)
@@ -194,7 +204,7 @@ async def protected(email: str,db: Session = Depends(get_db), authorize: AuthJWT
             html_content = f"<h3>Email Subject: {subject}</h3><h3>From: {email_from}</h3><h3>To: {email_to}</h3><h3>Email Date: {date}</h3> <p>{body}</p><br>"
             content += html_content
         if content:
-            html_content += f"<html><body>{content}</body></html>"
+            html_content = f"<html><body>{content}</body></html>"
             data_id = await generate_unique_uuid(db)
             file_name = f'{email}_{data_id}.pdf'
             pdf_folder_path = f'media/{user.id}/{data_id}'
@@ -212,12 +222,13 @@ async def protected(email: str,db: Session = Depends(get_db), authorize: AuthJWT
             pdf_buffer.seek(0)
             with open(file_path, 'wb') as pdf_file:
                 pdf_file.write(pdf_buffer.read())
+            storage_usage.add(user.id, os.path.getsize(file_path))
             # pdf_output_path = f'{email}_emails.pdf'
             # pdfkit.from_string(html_content, pdf_output_path)
             # pdfkit.from_string(html_content, pdf_output_path, configuration=pdfkit.configuration(wkhtmltopdf='C:\\Program Files\\wkhtmltopdf\\bin\\wkhtmltopdf.exe'))
             # return FileResponse(pdf_output_path, filename=f'{email}_emails.pdf', media_type="application/pdf")
             return JSONResponse(
-                content={"download_url": downloaf_url},
+                content={"download_url": downloaf_url, "failed_messages": len(errors)},
                 status_code=200,
             )
         
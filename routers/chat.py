@@ -1,38 +1,71 @@
 import asyncio
 import datetime
-import json
 import os
-import shutil
 import traceback
+from typing import Optional
 
-from fastapi import APIRouter, Depends, Query, Request
+import anyio
+from fastapi import APIRouter, Depends, Query, Request, Response
 from fastapi.concurrency import run_in_threadpool
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi_jwt_auth import AuthJWT
-from langchain import LLMChain
 from langchain.callbacks import get_openai_callback
-from langchain.chat_models import ChatOpenAI
-from langchain.embeddings.openai import OpenAIEmbeddings
 from langchain.prompts import PromptTemplate
-from langchain.vectorstores import FAISS
-from sqlalchemy import asc, desc
-from sqlalchemy.orm import Session
-
-from database import get_db
+from langchain.schema import HumanMessage
+from langchain_community.callbacks.openai_info import get_openai_token_cost_for_model
+from sqlalchemy import desc, tuple_
+from sqlalchemy.orm import Session, defer
+
+from clients import get_chat_llm, get_embeddings, get_llm_chain, latency_stats
+from config import settings
+from database import get_db, session
 from models.users import (
     MessageType,
-    UserCreditHistory,
     Chat,
     ChatMessage,
 )
-from services import get_user
+from retrieval.answer_cache import answer_cache, prompt_version
+from retrieval.bm25 import lexical_hits, load_lexical_index, reciprocal_rank_fusion
+from retrieval.consolidated import load_consolidated_index
+from retrieval.context import build_context
+from retrieval.index_cache import index_cache
+from retrieval.search import materialize_hits, rank_indexes
+from retrieval.segments import load_segments
+from ledger import CreditLedger
+from services import get_user, is_admin
+from transcripts import append_transcript, iter_transcript_json, transcript_exists
 from utils import (
     save_chat_message,
-    format_page_content
+    format_page_content,
+    sse_event,
+    encode_cursor,
+    decode_cursor
 )
 
 router = APIRouter()
 
+ANSWER_PROMPT = PromptTemplate(
+    template=f"""\
+            You are a chatbot assisting in a conversation with a human.
+
+            Using both your built-in knowledge and the following extracted parts of a long document, please provide an answer to the given question.
+
+            Your answer should be as detailed as possible if necessary.
+
+            If the document does not contain relevant information for answering the question, please make that clear in your response.
+
+            ---
+            Context:
+
+            ```
+            {{context}}
+            ```
+            ---
+
+            Question: {{question}}""",
+    input_variables=["context", "question"],
+)
+
 
 def log_error(customer_id, error_message, traceback_str):
     error_folder = "chat_error_logs"
@@ -48,35 +81,75 @@ def log_error(customer_id, error_message, traceback_str):
 @router.get("/chat-messages")
 async def get_chat_messages(
         request: Request,
+        response: Response,
         chat_id: str = Query(..., title="Chat ID from Query Parameter"),
+        limit: int = Query(50, ge=1, le=200),
+        before: Optional[str] = Query(None, title="Cursor from the X-Next-Cursor header"),
+        include_context: bool = Query(False),
         db: Session = Depends(get_db),
         authorize: AuthJWT = Depends()
 ):
     authorize.jwt_required()
     current_user = authorize.get_jwt_subject()
     user_obj = get_user(current_user)
-    chat_id = chat_id
+    query = db.query(ChatMessage).filter(ChatMessage.chat_id == chat_id)
+    if not include_context:
+        query = query.options(defer(ChatMessage.context_text), defer(ChatMessage.message_metadata))
+    if before:
+        try:
+            updated_at, message_id = decode_cursor(before)
+        except ValueError:
+            return JSONResponse(
+                content={"status": "error", "message": "Invalid cursor"},
+                status_code=400,
+            )
+        query = query.filter(tuple_(ChatMessage.updated_at, ChatMessage.id) < (updated_at, message_id))
+
+    # Newest page first, returned oldest to newest like the full history
     messages = (
-        db.query(ChatMessage)
-        .filter(ChatMessage.chat_id == chat_id)
-        .order_by(asc(ChatMessage.updated_at))
+        query.order_by(desc(ChatMessage.updated_at), desc(ChatMessage.id))
+        .limit(limit + 1)
         .all()
     )
+    if len(messages) > limit:
+        messages = messages[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(messages[-1].updated_at, messages[-1].id)
+    messages.reverse()
     return messages
 
 
 @router.get("/chat")
-async def get_chat(request: Request, db: Session = Depends(get_db), authorize: AuthJWT = Depends()):
+async def get_chat(
+        request: Request,
+        response: Response,
+        limit: int = Query(50, ge=1, le=200),
+        before: Optional[str] = Query(None, title="Cursor from the X-Next-Cursor header"),
+        db: Session = Depends(get_db),
+        authorize: AuthJWT = Depends()
+):
     authorize.jwt_required()
     current_user = authorize.get_jwt_subject()
     user_obj = get_user(current_user)
     user_id = user_obj.id
+    query = db.query(Chat).filter(Chat.user_id == user_id)
+    if before:
+        try:
+            updated_at, chat_id = decode_cursor(before)
+        except ValueError:
+            return JSONResponse(
+                content={"status": "error", "message": "Invalid cursor"},
+                status_code=400,
+            )
+        query = query.filter(tuple_(Chat.updated_at, Chat.id) < (updated_at, chat_id))
+
     chats = (
-        db.query(Chat)
-        .filter(Chat.user_id == user_id)
-        .order_by(desc(Chat.updated_at))
+        query.order_by(desc(Chat.updated_at), desc(Chat.id))
+        .limit(limit + 1)
         .all()
     )
+    if len(chats) > limit:
+        chats = chats[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(chats[-1].updated_at, chats[-1].id)
     return chats
 
 
@@ -153,20 +226,145 @@ async def create_chat(request: Request, data: dict, db: Session = Depends(get_db
     return chat
 
 
+async def retrieve_documents(customer_id, data_ids, query, embeddings):
+    """
+    Return formatted copies of the chunks selected for the prompt, along with the
+    query embedding used to find them.
+    """
+    persist_directory = [
+        f"trained_db/{customer_id}/{data_id}_all_embeddings" for data_id in data_ids
+    ]
+    consolidated = None
+    if settings.CONSOLIDATED_INDEX:
+        consolidated = await run_in_threadpool(load_consolidated_index, customer_id, embeddings)
+    if consolidated is not None and consolidated.covers(data_ids):
+        segments = None
+    else:
+        segments = []
+        for filename in persist_directory:
+            loaded = await run_in_threadpool(load_segments, filename, embeddings)
+            if not loaded:
+                # Deleted, never trained or someone else's data_id: no context to answer from
+                raise FileNotFoundError(f"No index segments in {filename}")
+            segments.extend(loaded)
+
+    # Embed the query once and gather candidate chunks across all documents
+    query_embedding = await embeddings.aembed_query(query)
+    docs = await run_in_threadpool(
+        select_context, consolidated, segments, data_ids, query, query_embedding
+    )
+    return docs, query_embedding
+
+
+def select_context(consolidated, segments, data_ids, query, query_embedding):
+    """Rank the chunks of ``data_ids`` across every index segment and fit the best into the prompt."""
+    k = settings.CONTEXT_CANDIDATES
+    if segments is None:
+        paths, stores = consolidated.paths, consolidated.stores
+        masks = consolidated.masks(data_ids)
+        hits = consolidated.rank(query_embedding, data_ids, k)
+    else:
+        paths = [path for path, _ in segments]
+        stores = [store for _, store in segments]
+        masks = None
+        hits = rank_indexes(stores, query_embedding, k)
+
+    # Fuse with BM25 hits so exact terms (ids, names, keys) are found too
+    lexical = []
+    if settings.HYBRID_SEARCH:
+        lexical_indexes = [load_lexical_index(path) for path in paths]
+        lexical = lexical_hits(stores, lexical_indexes, query, k, masks)
+        if lexical:
+            hits = reciprocal_rank_fusion([hits, lexical], k, settings.HYBRID_RRF_K)
+    candidates = materialize_hits(stores, hits, return_vectors=True)
+
+    # Copy before formatting, the documents belong to the cached index's docstore
+    candidates = [(doc.copy(), score, vector) for doc, score, vector in candidates]
+    for doc, _, _ in candidates:
+        doc.page_content = format_page_content(doc.page_content)
+
+    # Fill the token budget with relevant chunks that do not repeat each other
+    return build_context(
+        candidates,
+        query_embedding,
+        settings.CONTEXT_TOKEN_BUDGET,
+        settings.CONTEXT_MMR_LAMBDA,
+        rank_relevance=bool(lexical),
+    )
+
+
+def record_answer(db, customer_id, chat_id, query, answer, docs, context):
+    """Append the answer to the transcript and stage its chat messages."""
+    append_transcript(customer_id, chat_id, query, answer)
+
+    save_chat_message(
+        db=db,
+        user_id=customer_id,
+        chat_id=chat_id,
+        message_text=query,
+        message_type=MessageType.QUESTION,
+    )
+    if context == "true":
+        save_chat_message(
+            db=db,
+            user_id=customer_id,
+            chat_id=chat_id,
+            message_text=answer,
+            message_type=MessageType.ANSWER,
+            context_text=list(map(lambda doc: doc.page_content, docs)),
+            message_metadata=list(map(lambda doc: doc.metadata, docs)),
+        )
+    else:
+        save_chat_message(
+            db=db,
+            user_id=customer_id,
+            chat_id=chat_id,
+            message_text=answer,
+            message_type=MessageType.ANSWER,
+        )
+
+
+def format_answer(query, answer, cost, docs, context, cached=False):
+    if context == "true":
+        return {
+            "question": query,
+            "answer": answer,
+            "context": list(map(lambda doc: doc.page_content, docs)),
+            "metadata": list(map(lambda doc: doc.metadata, docs)),
+            "credit": cost,
+            "cached": cached,
+        }
+    return {"question": query, "answer": answer, "credit": cost, "cached": cached}
+
+
+def get_chat_by_id(db, chat_id):
+    return db.query(Chat).filter(Chat.id == chat_id).first()
+
+
 @router.post("/chat/queries")
-async def chat_chatbot(request: Request, data: dict, db: Session = Depends(get_db), authorize: AuthJWT = Depends()):
+async def chat_chatbot(request: Request, data: dict, authorize: AuthJWT = Depends()):
     authorize.jwt_required()
     current_user = authorize.get_jwt_subject()
     user_obj = get_user(current_user)
 
     customer_id = user_obj.id
     queries_data = data.get("queries_data")
+    semaphore = asyncio.Semaphore(settings.CHAT_QUERY_CONCURRENCY)
+    ledger = CreditLedger(customer_id)
 
     async def process_query(qd):
+        # Every query gets its own session so the batch can run concurrently
+        async with semaphore:
+            with session() as db:
+                response = await answer_query(db, qd)
+                await run_in_threadpool(db.commit)
+                return response
+
+    async def answer_query(db, qd):
         query = qd.get("query")
         data_ids = qd.get("data_ids")
         current_chat_id = qd.get("chat_id")
-        chat_obj = db.query(Chat).filter(Chat.id == current_chat_id).first()
+        chat_obj = await run_in_threadpool(get_chat_by_id, db, current_chat_id)
 
         if not chat_obj:
             return JSONResponse(
@@ -178,166 +376,186 @@ async def chat_chatbot(request: Request, data: dict, db: Session = Depends(get_d
         # If not present, default to False
         context = qd.get("context", "false")
         context = context.lower()
-        persist_directory = [
-            f"trained_db/{customer_id}/{data_id}_all_embeddings" for data_id in data_ids
-        ]
-        temp_persist_directory = (
-            f"temp_trained_db/{customer_id}/{current_chat_id}_all_embeddings"
-        )
-        temp_directory = f"temp_trained_db/{customer_id}"
-        if not os.path.exists("chat"):
-            os.makedirs("chat")
-
-        if not os.path.exists(f"chat/{customer_id}"):
-            os.makedirs(f"chat/{customer_id}")
 
-        if not os.path.exists(f"chat/{customer_id}/data"):
-            os.makedirs(f"chat/{customer_id}/data")
+        embeddings = get_embeddings()
+        answer_chain = get_llm_chain(ANSWER_PROMPT)
+        llm = answer_chain.llm
 
-        # Define the path of the JSON file
-        file_path = f"chat/{customer_id}/data/{current_chat_id}.json"
+        try:
+            docs, query_embedding = await retrieve_documents(customer_id, data_ids, query, embeddings)
+        except Exception as e:
+            error_message = f"Error Loading Data: {str(e)}"
+            traceback_str = traceback.format_exc()
+            log_error(customer_id, error_message, traceback_str)
+            return {"Error": "Error while loading data(embeddigs)"}
 
-        # Check if the JSON file exists
-        if not os.path.exists(file_path):
-            with open(file_path, "w") as f:
-                f.write(json.dumps({"chat": []}))
+        cost = 0
 
-        with open(file_path, "r") as f:
-            chat_data = json.load(f)
+        # Extract "page_content" from each Document and concatenate into a single string
+        combined_page_content = "\n\n".join(doc.page_content for doc in docs)
 
-        embeddings = OpenAIEmbeddings()
-        llm = ChatOpenAI(temperature=0.1, model_name="gpt-3.5-turbo", max_tokens=2048)
+        # Reuse a previous answer to the same question over the same chunks, free of charge
+        version = prompt_version(ANSWER_PROMPT, llm)
+        answer = answer_cache.get(query, docs, version, query_embedding)
+        cached = answer is not None
 
-        ANSWER_PROMPT = PromptTemplate(
-            template=f"""\
-            You are a chatbot assisting in a conversation with a human.
+        # Generate final answer
+        if not cached:
+            with get_openai_callback() as cb:
+                answer = await answer_chain.arun(
+                    {"context": combined_page_content, "question": query}
+                )
+                cost += cb.total_cost * 5 * 20
+            answer_cache.put(query, docs, version, answer, query_embedding)
+
+        ledger.charge(cost)
+        await run_in_threadpool(
+            record_answer, db, customer_id, current_chat_id, query, answer, docs, context
+        )
+        return format_answer(query, answer, cost, docs, context, cached=cached)
 
-            Using both your built-in knowledge and the following extracted parts of a long document, please provide an answer to the given question.
+    futures = [process_query(qd) for qd in queries_data]
+    try:
+        # Wait for every query, even when one fails, so no charge lands after the flush
+        responses = await asyncio.gather(*futures, return_exceptions=True)
+    finally:
+        # Settle the whole batch's charges at once
+        with session() as db:
+            await run_in_threadpool(ledger.flush, db)
+    for response in responses:
+        if isinstance(response, BaseException):
+            raise response
+    return responses
 
-            Your answer should be as detailed as possible if necessary.
 
-            If the document does not contain relevant information for answering the question, please make that clear in your response.
+@router.post("/chat/queries/stream")
+async def chat_chatbot_stream(request: Request, data: dict, db: Session = Depends(get_db), authorize: AuthJWT = Depends()):
+    """
+    Answer a single query (same fields as a ``queries_data`` entry) as server-sent events.
 
-            ---
-            Context:
+    Events are sent in order: ``context`` with the retrieved chunks and their metadata,
+    one ``token`` per generated piece of the answer, then ``done`` with the full answer
+    and the credit charged. Credit and chat messages are recorded once generation ends.
+    """
+    authorize.jwt_required()
+    current_user = authorize.get_jwt_subject()
+    user_obj = get_user(current_user)
 
-            ```
-            {{context}}
-            ```
-            ---
+    customer_id = user_obj.id
+    query = data.get("query")
+    data_ids = data.get("data_ids")
+    current_chat_id = data.get("chat_id")
+    context = data.get("context", "false").lower()
+    chat_obj = db.query(Chat).filter(Chat.id == current_chat_id).first()
 
-            Question: {{question}}""",
-            input_variables=["context", "question"],
+    if not chat_obj:
+        return JSONResponse(
+            content={"status": "error", "message": "This session not exist"},
+            status_code=404,
         )
-        answer_chain = LLMChain(llm=llm, prompt=ANSWER_PROMPT)
+
+    async def event_stream():
+        embeddings = get_embeddings()
+        llm = get_chat_llm()
 
         try:
-            indexes = [
-                FAISS.load_local(filename, embeddings) for filename in persist_directory
-            ]
+            docs, query_embedding = await retrieve_documents(customer_id, data_ids, query, embeddings)
         except Exception as e:
-            if os.path.exists(temp_directory):
-                shutil.rmtree(temp_directory)
             error_message = f"Error Loading Data: {str(e)}"
             traceback_str = traceback.format_exc()
             log_error(customer_id, error_message, traceback_str)
-            return {"Error": "Error while loading data(embeddigs)"}
-
-        # Aggregate the top 3 chunks from each document
-        docs = [
-            doc
-            for index in indexes
-            for doc in index.similarity_search_with_relevance_scores(query, k=3)
-        ]
-        # Sort the chunks by their relevance scores in descending order
-        docs = sorted(docs, key=lambda x: x[1], reverse=True)
-        # Select the first 3 chunks in total
-        docs, _ = zip(*docs[:3])
-
-        cost = 0
-
-        for doc in docs:
-            # Format page contents asynchronously
-            formatted_result = await run_in_threadpool(
-                format_page_content, doc.page_content
+            yield sse_event("error", {"Error": "Error while loading data(embeddigs)"})
+            return
+
+        yield sse_event("context", {
+            "question": query,
+            "context": list(map(lambda doc: doc.page_content, docs)),
+            "metadata": list(map(lambda doc: doc.metadata, docs)),
+        })
+
+        version = prompt_version(ANSWER_PROMPT, llm)
+        answer = answer_cache.get(query, docs, version, query_embedding)
+        if answer is not None:
+            yield sse_event("token", {"token": answer})
+            await run_in_threadpool(
+                record_answer, db, customer_id, current_chat_id, query, answer, docs, context
             )
-            doc.page_content = formatted_result
+            await run_in_threadpool(db.commit)
+            yield sse_event("done", format_answer(query, answer, 0, docs, context, cached=True))
+            return
 
-        # Extract "page_content" from each Document and concatenate into a single string
         combined_page_content = "\n\n".join(doc.page_content for doc in docs)
-
-        # Generate final answer
-        with get_openai_callback() as cb:
-            answer = answer_chain.run(
-                {"context": combined_page_content, "question": query}
-            )
-            cost += cb.total_cost * 5 * 20
-
-        user_obj.credit -= cost
-        credit_history = UserCreditHistory(user_id=user_obj.id, credit=cost)
-        db.add(credit_history)
-        db.commit()
+        prompt = ANSWER_PROMPT.format(context=combined_page_content, question=query)
+        tokens = []
+        failed = False
         try:
-            db.refresh(user_obj)
+            async for chunk in llm.astream(prompt):
+                tokens.append(chunk.content)
+                yield sse_event("token", {"token": chunk.content})
         except Exception as e:
-            print(e)
-
-        db.refresh(credit_history)
+            # A half generated answer is neither recorded nor charged
+            failed = True
+            log_error(customer_id, f"Error Generating Answer: {str(e)}", traceback.format_exc())
+            yield sse_event("error", {"Error": "Error while generating the answer"})
+            return
+        finally:
+            # Streamed completions carry no usage report, so price the tokens ourselves.
+            # Runs on client disconnect too, the tokens generated so far are still billed:
+            # Starlette cancels the stream on disconnect, so the settlement is shielded.
+            answer = "".join(tokens)
+            prompt_tokens = llm.get_num_tokens_from_messages([HumanMessage(content=prompt)])
+            completion_tokens = llm.get_num_tokens(answer)
+            cost = (
+                get_openai_token_cost_for_model(llm.model_name, prompt_tokens)
+                + get_openai_token_cost_for_model(llm.model_name, completion_tokens, is_completion=True)
+            ) * 5 * 20
+            if tokens and not failed:
+                with anyio.CancelScope(shield=True):
+                    await run_in_threadpool(
+                        record_answer, db, customer_id, current_chat_id, query, answer, docs, context
+                    )
+                    await run_in_threadpool(db.commit)
+                    ledger = CreditLedger(customer_id)
+                    ledger.charge(cost)
+                    await run_in_threadpool(ledger.flush, db)
+
+        answer_cache.put(query, docs, version, answer, query_embedding)
+        yield sse_event("done", format_answer(query, answer, cost, docs, context))
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+@router.get("/chat/index-cache")
+async def get_index_cache_stats(request: Request, authorize: AuthJWT = Depends()):
+    authorize.jwt_required()
+    if not is_admin(authorize.get_jwt_subject()):
+        return JSONResponse(
+            content={"status": "error", "message": "Only admins can view these stats"},
+            status_code=403,
+        )
+    return index_cache.stats()
 
-        if os.path.exists(temp_directory):
-            shutil.rmtree(temp_directory)
 
-        # Save the query and answer in the JSON file
-        chat_data["chat"].append({"user": query, "answer": answer})
-        with open(file_path, "w") as f:
-            json.dump(chat_data, f)
+@router.get("/chat/answer-cache")
+async def get_answer_cache_stats(request: Request, authorize: AuthJWT = Depends()):
+    authorize.jwt_required()
+    if not is_admin(authorize.get_jwt_subject()):
+        return JSONResponse(
+            content={"status": "error", "message": "Only admins can view these stats"},
+            status_code=403,
+        )
+    return answer_cache.stats()
 
-        if context == "false":
-            save_chat_message(
-                db=db,
-                user_id=customer_id,
-                chat_id=current_chat_id,
-                message_text=query,
-                message_type=MessageType.QUESTION,
-            )
-            save_chat_message(
-                db=db,
-                user_id=customer_id,
-                chat_id=current_chat_id,
-                message_text=answer,
-                message_type=MessageType.ANSWER,
-            )
-            return {"question": query, "answer": answer, "credit": cost}
-
-        elif context == "true":
-            save_chat_message(
-                db=db,
-                user_id=customer_id,
-                chat_id=current_chat_id,
-                message_text=query,
-                message_type=MessageType.QUESTION,
-            )
-            save_chat_message(
-                db=db,
-                user_id=customer_id,
-                chat_id=current_chat_id,
-                message_text=answer,
-                message_type=MessageType.ANSWER,
-                context_text=list(map(lambda doc: doc.page_content, docs)),
-                message_metadata=list(map(lambda doc: doc.metadata, docs)),
-            )
-            return {
-                "question": query,
-                "answer": answer,
-                "context": list(map(lambda doc: doc.page_content, docs)),
-                "metadata": list(map(lambda doc: doc.metadata, docs)),
-                "credit": cost,
-            }
 
-    futures = [process_query(qd) for qd in queries_data]
-    responses = await asyncio.gather(*futures)
-    db.commit()
-    return responses
+@router.get("/chat/client-stats")
+async def get_client_stats(request: Request, authorize: AuthJWT = Depends()):
+    authorize.jwt_required()
+    if not is_admin(authorize.get_jwt_subject()):
+        return JSONResponse(
+            content={"status": "error", "message": "Only admins can view these stats"},
+            status_code=403,
+        )
+    return latency_stats.snapshot()
 
 
 @router.get("/chat/download")
@@ -346,18 +564,18 @@ async def download_chat_data(
         chat_id: str = Query(..., title="Chat ID from Query Parameter"),
         authorize: AuthJWT = Depends()
 ):
-    # Define the path of the JSON file
     authorize.jwt_required()
     current_user = authorize.get_jwt_subject()
     user_obj = get_user(current_user)
     customer_id = user_obj.id
-    file_path = f"chat/{customer_id}/data/{chat_id}.json"
 
-    # Check if the JSON file exists
-    if not os.path.exists(file_path):
+    # Check if the transcript exists
+    if not transcript_exists(customer_id, chat_id):
         return {"message": f"JSON file for user '{customer_id}' not found."}
 
-    # Provide the JSON file as a download
-    return FileResponse(
-        file_path, media_type="application/json", filename=f"{customer_id}.json"
+    # Stream the transcript as a JSON download
+    return StreamingResponse(
+        iter_transcript_json(customer_id, chat_id),
+        media_type="application/json",
+        headers={"Content-Disposition": f'attachment; filename="{customer_id}.json"'},
     )
@@ -1,6 +1,9 @@
 from fastapi import Request, Depends, APIRouter
 from fastapi_jwt_auth import AuthJWT
+from sqlalchemy.orm import Session
 
+from database import get_db
+from ledger import get_balance_by_email
 from services import get_user
 
 router = APIRouter()
@@ -12,3 +15,10 @@ async def get_user_data(request: Request, authorize: AuthJWT = Depends()):
     current_user = authorize.get_jwt_subject()
     user_obj = get_user(current_user)
     return user_obj
+
+
+@router.get("/user/credit")
+async def get_user_credit(request: Request, db: Session = Depends(get_db), authorize: AuthJWT = Depends()):
+    authorize.jwt_required()
+    current_user = authorize.get_jwt_subject()
+    return {"credit": get_balance_by_email(db, current_user)}
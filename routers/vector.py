@@ -1,26 +1,36 @@
-import datetime
+import asyncio
 import os
 import shutil
 import traceback
+import uuid
 
-import pandas as pd
 from dotenv import load_dotenv
 from fastapi import APIRouter, Depends, File, Form, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
 from fastapi_jwt_auth import AuthJWT
-from langchain.docstore.document import Document
-from langchain.document_loaders import UnstructuredWordDocumentLoader, PyPDFLoader
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.text_splitter import TokenTextSplitter
-from langchain.vectorstores import FAISS
 from sqlalchemy.orm import Session
 
+from clients import get_embeddings
+from config import settings
 from database import get_db
+from ingestion.jobs import IngestionJob, claim_retry, load_job, public_view
+from ingestion.pipeline import (
+    SUCCESS_MESSAGES,
+    get_job_workspace,
+    get_persist_directory,
+    job_queue,
+    log_error,
+    stage_stats
+)
+from ingestion.uploads import UploadTooLarge, save_upload
 from models.users import UserTrainData
-from services import get_user
+from retrieval.consolidated import remove_from_consolidated_index
+from retrieval.segments import remove_index
+from services import get_user, is_admin
+from storage import remove_path, storage_usage
 from utils import (
     convert_size,
-    create_train_data,
     generate_unique_uuid
 )
 
@@ -28,16 +38,28 @@ load_dotenv()
 
 router = APIRouter()
 
+# Room for the multipart boundaries and form fields around the file itself
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+def upload_too_large():
+    return JSONResponse(
+        content={
+            "status": "error",
+            "message": f"File is larger than the {convert_size(settings.MAX_UPLOAD_BYTES)} upload limit",
+        },
+        status_code=413,
+    )
 
-def log_error(customer_id, error_message, traceback_str):
-    error_folder = "train_error_logs"
-    os.makedirs(error_folder, exist_ok=True)
-    error_log_path = os.path.join(error_folder, f"error_log_{customer_id}.txt")
 
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(error_log_path, "a") as error_log:
-        error_log.write(f"[{timestamp}] {error_message}\n")
-        error_log.write(traceback_str + "\n")
+def storage_quota_exceeded():
+    return JSONResponse(
+        content={
+            "status": "error",
+            "message": f"Not enough space left in your {convert_size(settings.STORAGE_QUOTA_BYTES)} storage quota",
+        },
+        status_code=413,
+    )
 
 
 @router.get("/get-train-data")
@@ -65,6 +87,7 @@ async def train(
     if chat_id == "null":
         chat_id = None
 
+    customer_id = None
     try:
         authorize.jwt_required()
         current_user = authorize.get_jwt_subject()
@@ -76,227 +99,8 @@ async def train(
             )
 
         customer_id = user_obj.id
-        data_id = await generate_unique_uuid(db)
-        persist_directory = f"trained_db/{customer_id}/{data_id}_all_embeddings"
-
-        if file:
-            filename = file.filename.lower()
-
-            if filename.endswith(".pdf"):
-                pdf_folder_path = f"pdf_temp_{customer_id}"
-                os.makedirs(pdf_folder_path, exist_ok=True)
-                file_path = os.path.join(pdf_folder_path, filename)
-
-                with open(file_path, "wb") as f:
-                    f.write(await file.read())
-
-                data_size = os.path.getsize(file_path)
-
-                try:
-                    documents = PyPDFLoader(file_path).load()
-                    text_splitter = TokenTextSplitter(
-                        chunk_size=1024, chunk_overlap=256
-                    )
-                    split_docs = text_splitter.split_documents(documents)
-
-                    for docs in split_docs:
-                        docs.metadata["page"] = docs.metadata.get("page") + 1
-                        docs.metadata["filename"] = filename
-
-                    embeddings = OpenAIEmbeddings()
-
-                    new_vectordb = FAISS.from_documents(split_docs, embeddings)
-                    try:
-                        old_vectordb = FAISS.load_local(persist_directory, embeddings)
-                        old_vectordb.merge_from(new_vectordb)
-                        old_vectordb.save_local(persist_directory)
-                        print("Previous Embeddings were loaded.")
-                    except:
-                        new_vectordb.save_local(persist_directory)
-                        print("New VectorStore is initialized")
-                except Exception as e:
-                    error_message = f"Error {str(e)}"
-                    traceback_str = traceback.format_exc()
-                    log_error(customer_id, error_message, traceback_str)
-                    return JSONResponse(
-                        content={
-                            "status": "error",
-                            "message": "file upload unsuccessful",
-                        },
-                        status_code=400,
-                    )
-
-                except Exception as e:
-                    # Log the traceback information to a file
-                    error_message = (
-                        f"Error processing PDF: {str(e)} \n s3 file upload error: {e}"
-                    )
-                    traceback_str = traceback.format_exc()
-                    log_error(customer_id, error_message, traceback_str)
-                    return JSONResponse(
-                        content={
-                            "status": "error",
-                            "message": "Rate Limit Reached For Your Account",
-                        },
-                        status_code=400,
-                    )
-
-                finally:
-                    shutil.rmtree(pdf_folder_path)
-                trained_data_object = await create_train_data(
-                    db,
-                    id=data_id,
-                    source_filename=file.filename,
-                    source_file_extensions=".pdf",
-                    trained_data_path=persist_directory,
-                    user_id=user_obj.id,
-                    chat_id=chat_id,
-                    file_size=data_size,
-                )
-                return {
-                    "answer": "PDF EMBEDDINGS GENERATED SUCCESSFULLY",
-                    "data": trained_data_object,
-                }
-
-            elif filename.endswith(".docx"):
-                word_folder_path = f"word_temp_{customer_id}"
-                os.makedirs(word_folder_path, exist_ok=True)
-                file_path = os.path.join(word_folder_path, file.filename)
-
-                try:
-                    with open(file_path, "wb") as f:
-                        f.write(await file.read())
-                    file_size = os.path.getsize(file_path)
-
-                    documents = UnstructuredWordDocumentLoader(file_path).load()
-                    text_splitter = TokenTextSplitter(chunk_size=500, chunk_overlap=0)
-                    split_docs = text_splitter.split_documents(documents)
-                    embeddings = OpenAIEmbeddings()
-                    new_vectordb = FAISS.from_documents(split_docs, embeddings)
-                    try:
-                        old_vectordb = FAISS.load_local(persist_directory, embeddings)
-                        old_vectordb.merge_from(new_vectordb)
-                        old_vectordb.save_local(persist_directory)
-                        print("Previous Embeddings were loaded.")
-                    except:
-                        new_vectordb.save_local(persist_directory)
-                        print("New VectorStore is initialized")
-
-                except Exception as e:
-                    error_message = f"Error: {str(e)}"
-                    traceback_str = traceback.format_exc()
-                    log_error(customer_id, error_message, traceback_str)
-                    return JSONResponse(
-                        content={
-                            "status": "error",
-                            "message": "file upload unsuccessful",
-                        },
-                        status_code=400,
-                    )
-
-                except Exception as e:
-                    # Log the traceback information to a file
-                    error_message = f"Error processing DOCX: {str(e)}"
-                    traceback_str = traceback.format_exc()
-                    log_error(customer_id, error_message, traceback_str)
-                    return JSONResponse(
-                        content={
-                            "status": "error",
-                            "message": "Rate Limit Reached For Your Account",
-                        },
-                        status_code=400,
-                    )
-
-                finally:
-                    shutil.rmtree(word_folder_path)
-                trained_data_object = await create_train_data(
-                    db,
-                    id=data_id,
-                    source_filename=file.filename,
-                    source_file_extensions=".docx",
-                    trained_data_path=persist_directory,
-                    user_id=user_obj.id,
-                    chat_id=chat_id,
-                    file_size=file_size,
-                )
-                return {
-                    "answer": "DOCX EMBEDDINGS GENERATED SUCCESSFULLY",
-                    "data": trained_data_object,
-                }
-
-            elif filename.endswith(".xlsx"):
-                excel_folder_path = f"excel_temp_{customer_id}"
-                os.makedirs(excel_folder_path, exist_ok=True)
-                file_path = os.path.join(excel_folder_path, file.filename)
-                try:
-                    with open(file_path, "wb") as f:
-                        f.write(await file.read())
-
-                    file_size = os.path.getsize(file_path)
-
-                    # convert xlsx file to csv
-                    df = pd.read_excel(file_path, header=None)
-                    rows = df.apply(lambda row: f"{row[0]}: {row[1]}", axis=1).to_list()
-                    # create documents from groups
-                    documents = [Document(page_content=row) for row in rows]
-
-                    embeddings = OpenAIEmbeddings()
-                    new_vectordb = FAISS.from_documents(documents, embeddings)
-                    try:
-                        old_vectordb = FAISS.load_local(persist_directory, embeddings)
-                        old_vectordb.merge_from(new_vectordb)
-                        old_vectordb.save_local(persist_directory)
-                        print("Previous Embeddings were loaded.")
-                    except:
-                        new_vectordb.save_local(persist_directory)
-                        print("New VectorStore is initialized")
-
-                except Exception as e:
-                    error_message = f"Error : {str(e)}"
-                    traceback_str = traceback.format_exc()
-                    log_error(customer_id, error_message, traceback_str)
-                    return JSONResponse(
-                        content={
-                            "status": "error",
-                            "message": "file upload unsuccessful",
-                        },
-                        status_code=400,
-                    )
-
-                except Exception as e:
-                    # Log the traceback information to a file
-                    error_message = (
-                        f"Error processing XLSX: {str(e)} \n s3 file upload error: {e}"
-                    )
-                    traceback_str = traceback.format_exc()
-                    log_error(customer_id, error_message, traceback_str)
-                    return JSONResponse(
-                        content={
-                            "status": "error",
-                            "message": "Rate Limit Reached For Your Account",
-                        },
-                        status_code=400,
-                    )
-
-                finally:
-                    shutil.rmtree(excel_folder_path)
-
-                trained_data_object = await create_train_data(
-                    db,
-                    id=data_id,
-                    source_filename=file.filename,
-                    source_file_extensions=".xlsx",
-                    trained_data_path=persist_directory,
-                    user_id=user_obj.id,
-                    chat_id=chat_id,
-                    file_size=file_size,
-                )
-                return {
-                    "answer": "XLSX EMBEDDINGS GENERATED SUCCESSFULLY",
-                    "data": trained_data_object,
-                }
-
-        else:
+        extension = os.path.splitext(file.filename.lower())[1] if file else ""
+        if extension not in SUCCESS_MESSAGES:
             return JSONResponse(
                 content={
                     "status": "error",
@@ -305,6 +109,50 @@ async def train(
                 status_code=400,
             )
 
+        remaining = await run_in_threadpool(storage_usage.remaining, customer_id)
+        if remaining == 0:
+            return storage_quota_exceeded()
+        max_bytes = settings.MAX_UPLOAD_BYTES if remaining is None else min(settings.MAX_UPLOAD_BYTES, remaining)
+        too_large = upload_too_large if max_bytes == settings.MAX_UPLOAD_BYTES else storage_quota_exceeded
+
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > max_bytes + MULTIPART_OVERHEAD:
+            return too_large()
+
+        data_id = await generate_unique_uuid(db)
+        job_id = uuid.uuid4().hex
+        workspace = get_job_workspace(customer_id, job_id)
+        os.makedirs(workspace, exist_ok=True)
+        file_path = os.path.join(workspace, os.path.basename(file.filename))
+        try:
+            file_size, sha256 = await save_upload(file, file_path, max_bytes=max_bytes)
+        except UploadTooLarge:
+            shutil.rmtree(workspace, ignore_errors=True)
+            return too_large()
+        storage_usage.add(customer_id, file_size)
+
+        job = IngestionJob(
+            customer_id=customer_id,
+            chat_id=chat_id,
+            data_id=data_id,
+            filename=file.filename,
+            extension=extension,
+            file_path=file_path,
+            workspace=workspace,
+            file_size=file_size,
+            sha256=sha256,
+            job_id=job_id,
+        )
+        try:
+            job_queue.submit(job)
+        except asyncio.QueueFull:
+            remove_path(customer_id, workspace)
+            return JSONResponse(
+                content={"status": "error", "message": "Too many files are being trained, please try again shortly"},
+                status_code=503,
+            )
+        return JSONResponse(content=public_view(job.to_dict()), status_code=202)
+
     except Exception as e:
         # Log the traceback information for the general error
         error_message = f"General Error: {str(e)}"
@@ -319,6 +167,68 @@ async def train(
         )
 
 
+@router.get("/train/storage")
+async def get_storage_usage(authorize: AuthJWT = Depends()):
+    authorize.jwt_required()
+    current_user = authorize.get_jwt_subject()
+    user_obj = get_user(current_user)
+    used = await run_in_threadpool(storage_usage.get, user_obj.id)
+    return {"used_bytes": used, "quota_bytes": settings.STORAGE_QUOTA_BYTES}
+
+
+@router.get("/train/stage-stats")
+async def get_stage_stats(authorize: AuthJWT = Depends()):
+    authorize.jwt_required()
+    if not is_admin(authorize.get_jwt_subject()):
+        return JSONResponse(
+            content={"status": "error", "message": "Only admins can view these stats"},
+            status_code=403,
+        )
+    return stage_stats.snapshot()
+
+
+@router.get("/train/jobs/{job_id}")
+async def get_train_job(job_id: str, authorize: AuthJWT = Depends()):
+    authorize.jwt_required()
+    current_user = authorize.get_jwt_subject()
+    user_obj = get_user(current_user)
+    job = load_job(job_id)
+    if job is None or job["customer_id"] != str(user_obj.id):
+        return JSONResponse(
+            content={"status": "error", "message": "Training job not found"},
+            status_code=404,
+        )
+    return public_view(job)
+
+
+@router.post("/train/jobs/{job_id}/retry")
+async def retry_train_job(job_id: str, authorize: AuthJWT = Depends()):
+    authorize.jwt_required()
+    current_user = authorize.get_jwt_subject()
+    user_obj = get_user(current_user)
+    record = load_job(job_id)
+    if record is None or record["customer_id"] != str(user_obj.id):
+        return JSONResponse(
+            content={"status": "error", "message": "Training job not found"},
+            status_code=404,
+        )
+    job = await run_in_threadpool(claim_retry, job_id, user_obj.id)
+    if job is None:
+        return JSONResponse(
+            content={"status": "error", "message": "This job cannot be retried, please upload the file again"},
+            status_code=409,
+        )
+    try:
+        job_queue.submit(job)
+    except asyncio.QueueFull:
+        job.fail(record["message"], retryable=True)
+        return JSONResponse(
+            content={"status": "error", "message": "Too many files are being trained, please try again shortly"},
+            status_code=503,
+        )
+    return JSONResponse(content=public_view(job.to_dict()), status_code=202)
+
+
 @router.post("/train/delete")
 async def deletetxt(request: Request, data: dict, db: Session = Depends(get_db), authorize: AuthJWT = Depends()):
     authorize.jwt_required()
@@ -326,8 +236,9 @@ async def deletetxt(request: Request, data: dict, db: Session = Depends(get_db),
     user_obj = get_user(current_user)
     data_id = data.get("data_id")
     file_name = data.get("file_name")
-    customer_id = data.get("customer_id")
-    if file_name and customer_id and data_id:
+    # Only the caller's own data can be deleted, whatever customer_id the body names
+    customer_id = str(user_obj.id)
+    if file_name and data_id:
         try:
             user_train_data = (
                 db.query(UserTrainData)
@@ -341,6 +252,10 @@ async def deletetxt(request: Request, data: dict, db: Session = Depends(get_db),
                 )
             db.delete(user_train_data)
             db.commit()
+            freed = await run_in_threadpool(remove_index, get_persist_directory(customer_id, data_id))
+            storage_usage.add(customer_id, -freed)
+            if settings.CONSOLIDATED_INDEX:
+                await run_in_threadpool(remove_from_consolidated_index, customer_id, data_id, get_embeddings())
         except Exception as e:
             traceback_str = traceback.format_exc()
             log_error(customer_id, e, traceback_str)
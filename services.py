@@ -1,5 +1,6 @@
 from typing import Optional
 
+from config import settings
 from database import session
 from models.users import User
 from models.schemas import Register
@@ -10,6 +11,10 @@ def get_user(email: str) -> Optional[User]:
         return db.query(User).filter(User.email == email).one_or_none()
 
 
+def is_admin(email: str) -> bool:
+    return email in settings.ADMIN_EMAILS
+
+
 def update_access_token(email: str, access_token: str,refresh_token:str):
     with session() as db:
         user = db.query(User).filter(User.email == email).first()
@@ -0,0 +1,97 @@
+import os
+import shutil
+import threading
+
+from config import settings
+
+INDEX_ROOT = "trained_db"
+MEDIA_ROOT = "media"
+CHAT_ROOT = "chat"
+UPLOAD_ROOT = "train_temp"
+# Every directory holding per-user files, each laid out as ``{root}/{customer_id}/...``
+USER_ROOTS = (INDEX_ROOT, MEDIA_ROOT, CHAT_ROOT, UPLOAD_ROOT)
+
+
+def path_size(path):
+    """Bytes used by a file or everything under a directory; 0 if it does not exist."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for folder, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                total += os.path.getsize(os.path.join(folder, file_name))
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def user_directories(customer_id):
+    return [os.path.join(root, str(customer_id)) for root in USER_ROOTS]
+
+
+class StorageUsage:
+    """
+    Bytes each user has on disk across ``trained_db``, ``media``, ``chat`` and the
+    uploads waiting in ``train_temp``.
+
+    A user's total is measured with one directory walk the first time it is needed,
+    then kept up to date by ``add`` as uploads, indexes, PDFs and transcripts are
+    written and removed. Other worker processes write files too, so the reclaimer measures
+    every user again on each pass and the counts converge there.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bytes = {}
+
+    def measure(self, customer_id):
+        used = sum(path_size(path) for path in user_directories(customer_id))
+        with self._lock:
+            self._bytes[str(customer_id)] = used
+        return used
+
+    def get(self, customer_id):
+        with self._lock:
+            used = self._bytes.get(str(customer_id))
+        if used is None:
+            used = self.measure(customer_id)
+        return used
+
+    def add(self, customer_id, size):
+        """Record ``size`` bytes written (negative when removed) for an already measured user."""
+        with self._lock:
+            customer_id = str(customer_id)
+            if customer_id in self._bytes:
+                self._bytes[customer_id] = max(0, self._bytes[customer_id] + size)
+
+    def forget(self, customer_id):
+        with self._lock:
+            self._bytes.pop(str(customer_id), None)
+
+    def remaining(self, customer_id):
+        """Bytes left under ``STORAGE_QUOTA_BYTES``, or ``None`` when there is no quota."""
+        if settings.STORAGE_QUOTA_BYTES is None:
+            return None
+        return max(0, settings.STORAGE_QUOTA_BYTES - self.get(customer_id))
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._bytes)
+
+
+storage_usage = StorageUsage()
+
+
+def remove_path(customer_id, path):
+    """Delete a file or directory belonging to ``customer_id`` and return the bytes freed."""
+    size = path_size(path)
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    storage_usage.add(customer_id, -size)
+    return size
@@ -0,0 +1,15 @@
+import os
+import sys
+
+# config.Settings requires these; the tests never reach the database or OpenAI
+for name, value in {
+    "DATABASE_PORT": "5432",
+    "POSTGRES_PASSWORD": "test",
+    "POSTGRES_USER": "test",
+    "POSTGRES_DB": "test",
+    "POSTGRES_HOSTNAME": "localhost",
+    "OPENAI_API_KEY": "sk-test",
+}.items():
+    os.environ.setdefault(name, value)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,37 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from aiohttp import web
+
+
+class InFlight:
+    """Counts the requests a fake server is handling at once."""
+
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+
+    async def __aenter__(self):
+        self.current += 1
+        self.peak = max(self.peak, self.current)
+        # Let other requests arrive while this one is in flight
+        await asyncio.sleep(0.01)
+
+    async def __aexit__(self, *exc_info):
+        self.current -= 1
+
+
+@asynccontextmanager
+async def serve(routes):
+    """Run an aiohttp app with ``routes`` on a free local port and yield its base URL."""
+    app = web.Application()
+    app.add_routes(routes)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,114 @@
+import asyncio
+import time
+from collections import Counter
+
+import pytest
+from aiohttp import web
+
+from fake_api import InFlight, serve
+from ingestion import embedder
+from ingestion.embedder import EmbeddingEngine, EmbeddingRateLimited, TokenBucket
+
+
+@pytest.fixture(autouse=True)
+def word_token_counts(monkeypatch):
+    # tiktoken downloads its encodings on first use; the limiter only needs a count
+    monkeypatch.setattr(embedder, "count_tokens", lambda texts: [len(text.split()) for text in texts])
+
+
+def embedding_of(text):
+    return [float(len(text)), float(sum(map(ord, text)) % 997)]
+
+
+def embeddings_routes(in_flight, refuse):
+    """``POST /embeddings`` answering like OpenAI, or with the status ``refuse(texts, attempt)`` returns."""
+    attempts = Counter()
+
+    async def embeddings(request):
+        texts = (await request.json())["input"]
+        attempts[texts[0]] += 1
+        async with in_flight:
+            status = refuse(texts, attempts[texts[0]])
+            if status is not None:
+                return web.json_response(
+                    {"error": {"message": "refused", "type": "requests", "param": None, "code": None}},
+                    status=status,
+                    headers={"Retry-After": "0"},
+                )
+            # Out of order on purpose, the engine sorts by index
+            data = [{"object": "embedding", "index": i, "embedding": embedding_of(text)} for i, text in enumerate(texts)]
+            return web.json_response({"object": "list", "data": data[::-1], "model": "fake", "usage": {}})
+
+    return [web.post("/embeddings", embeddings)], attempts
+
+
+def make_engine(api_base, **kwargs):
+    return EmbeddingEngine(
+        model="fake",
+        batch_size=4,
+        max_in_flight=2,
+        tokens_per_minute=10 ** 9,
+        max_retries=3,
+        api_base=api_base,
+        backoff_base=0.01,
+        **kwargs,
+    )
+
+
+def test_retries_transient_errors_and_checkpoints_every_batch():
+    texts = [f"chunk {i}" for i in range(18)]
+    in_flight = InFlight()
+
+    def refuse(batch, attempt):
+        # The first attempt of every batch is rate limited or hits a server error, the second succeeds
+        if attempt == 1:
+            return 429 if batch[0] in ("chunk 0", "chunk 8", "chunk 16") else 503
+        return None
+
+    routes, attempts = embeddings_routes(in_flight, refuse)
+    checkpoints = []
+
+    async def run():
+        async with serve(routes) as api_base:
+            engine = make_engine(api_base)
+            return await engine.embed(texts, on_batch=lambda positions, vectors: checkpoints.append(positions))
+
+    vectors = asyncio.run(run())
+
+    assert vectors == [embedding_of(text) for text in texts]
+    assert sorted(position for positions in checkpoints for position in positions) == list(range(len(texts)))
+    assert len(checkpoints) == 5
+    assert set(attempts.values()) == {2}
+    assert in_flight.peak <= 2
+
+
+def test_keeps_finished_batches_when_rate_limited_for_good():
+    texts = [f"chunk {i}" for i in range(12)]
+    blocked = texts[4]
+    routes, attempts = embeddings_routes(InFlight(), lambda batch, attempt: 429 if batch[0] == blocked else None)
+    checkpoints = []
+
+    async def run():
+        async with serve(routes) as api_base:
+            engine = make_engine(api_base, backoff_max=0.01)
+            await engine.embed(texts, on_batch=lambda positions, vectors: checkpoints.append(positions))
+
+    with pytest.raises(EmbeddingRateLimited):
+        asyncio.run(run())
+
+    assert attempts[blocked] == 4
+    # Batches finished before the failure were handed over for checkpointing
+    assert [0, 1, 2, 3] in checkpoints
+    assert [4, 5, 6, 7] not in checkpoints
+
+
+def test_token_bucket_holds_requests_to_the_rate():
+    async def run():
+        bucket = TokenBucket(tokens_per_minute=600)
+        await bucket.acquire(600)
+        started = time.monotonic()
+        await bucket.acquire(5)
+        return time.monotonic() - started
+
+    # 600 tokens a minute refill 10 a second, so 5 more take about half a second
+    assert 0.4 <= asyncio.run(run()) < 1.0
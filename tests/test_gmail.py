@@ -0,0 +1,102 @@
+import asyncio
+from collections import Counter
+
+from aiohttp import web
+
+import gmail
+from config import settings
+from fake_api import InFlight, serve
+
+
+def messages_routes(in_flight, refuse):
+    """``GET .../messages/{id}`` answering like Gmail, or with the status ``refuse(id, attempt)`` returns."""
+    attempts = Counter()
+
+    async def message(request):
+        message_id = request.match_info["message_id"]
+        attempts[message_id] += 1
+        assert request.headers["Authorization"] == "Bearer token"
+        async with in_flight:
+            status = refuse(message_id, attempts[message_id])
+            if status is not None:
+                return web.json_response({"error": {"code": status}}, status=status, headers={"Retry-After": "0"})
+            return web.json_response({"id": message_id, "payload": {"headers": []}})
+
+    return [web.get("/gmail/v1/users/me/messages/{message_id}", message)], attempts
+
+
+def test_fetch_messages_retries_and_reports_partial_failures(monkeypatch):
+    message_ids = [f"m{i}" for i in range(30)]
+
+    def refuse(message_id, attempt):
+        if message_id == "m3":
+            return 404
+        if message_id == "m7":
+            return 500
+        # Every other message is rate limited once
+        return 429 if attempt == 1 else None
+
+    in_flight = InFlight()
+    routes, attempts = messages_routes(in_flight, refuse)
+
+    async def run():
+        async with serve(routes) as endpoint:
+            monkeypatch.setattr(settings, "GMAIL_API_ENDPOINT", endpoint)
+            return await gmail.fetch_messages("token", message_ids, concurrency=4, max_retries=2)
+
+    messages, errors = asyncio.run(run())
+
+    assert [message and message["id"] for message in messages] == [
+        None if message_id in ("m3", "m7") else message_id for message_id in message_ids
+    ]
+    assert {(error.message_id, error.status) for error in errors} == {("m3", 404), ("m7", 500)}
+    # Not found is final, server errors are retried until max_retries runs out
+    assert attempts["m3"] == 1
+    assert attempts["m7"] == 3
+    assert attempts["m0"] == 2
+    assert in_flight.peak <= 4
+
+
+def test_backoff_caps_retry_after():
+    assert gmail._backoff(0, "3600") == gmail.BACKOFF_MAX
+    assert gmail._backoff(0, "2") == 2.0
+    assert gmail._backoff(20) <= gmail.BACKOFF_MAX
+
+
+class FakeService:
+    """The slice of the Gmail API client ``list_message_ids`` uses, over ``total`` messages."""
+
+    def __init__(self, total):
+        self.total = total
+        self.requests = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def list(self, userId, q, maxResults, pageToken=None):
+        self.requests.append(maxResults)
+        start = int(pageToken or 0)
+        end = min(start + maxResults, self.total)
+        page = {"messages": [{"id": f"m{i}"} for i in range(start, end)]}
+        if end < self.total:
+            page["nextPageToken"] = str(end)
+        return FakeRequest(page)
+
+
+class FakeRequest:
+    def __init__(self, page):
+        self.page = page
+
+    def execute(self):
+        return self.page
+
+
+def test_list_message_ids_follows_pages_up_to_the_cap():
+    service = FakeService(total=1200)
+    assert gmail.list_message_ids(service, "q", max_messages=700) == [f"m{i}" for i in range(700)]
+    assert service.requests == [gmail.LIST_PAGE_SIZE, 700 - gmail.LIST_PAGE_SIZE]
+
+    assert len(gmail.list_message_ids(FakeService(total=40), "q", max_messages=700)) == 40
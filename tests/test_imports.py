@@ -0,0 +1,26 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# main itself connects to the database on import, so check what it imports, each in
+# a fresh interpreter where no earlier import has hidden a circular one
+@pytest.mark.parametrize("module", [
+    "ingestion.pipeline",
+    "reclaimer",
+    "retrieval.segments",
+    "transcripts",
+    "routers.chat",
+    "routers.vector",
+    "routers.users",
+    "routers.auth",
+])
+def test_module_imports_on_its_own(module):
+    result = subprocess.run(
+        [sys.executable, "-c", f"import {module}"], cwd=ROOT, capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,143 @@
+import fcntl
+import json
+import os
+import threading
+import uuid
+import weakref
+from contextlib import contextmanager
+
+from config import settings
+from storage import CHAT_ROOT, storage_usage
+
+TRANSCRIPT_ROOT = CHAT_ROOT
+
+# Held only while some thread uses or waits for them, so idle chats cost nothing
+_chat_locks = weakref.WeakValueDictionary()
+_chat_locks_guard = threading.Lock()
+
+
+def get_transcript_path(customer_id, chat_id):
+    return f"{TRANSCRIPT_ROOT}/{customer_id}/data/{chat_id}.jsonl"
+
+
+def get_legacy_transcript_path(customer_id, chat_id):
+    return f"{TRANSCRIPT_ROOT}/{customer_id}/data/{chat_id}.json"
+
+
+def get_chat_lock(customer_id, chat_id):
+    key = (str(customer_id), str(chat_id))
+    with _chat_locks_guard:
+        lock = _chat_locks.get(key)
+        if lock is None:
+            lock = _chat_locks[key] = threading.Lock()
+        return lock
+
+
+@contextmanager
+def locked_transcript(file_path):
+    """
+    Open ``file_path`` for appending with an exclusive ``flock`` held.
+
+    A migration replaces the file, so after locking, the open file is checked to
+    still be the one at ``file_path`` and reopened if not; otherwise a write could
+    land in the replaced copy.
+    """
+    while True:
+        f = open(file_path, "a")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            current = os.fstat(f.fileno()).st_ino == os.stat(file_path).st_ino
+        except FileNotFoundError:
+            current = False
+        if current:
+            break
+        f.close()
+    try:
+        yield f
+    finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+
+def migrate_transcript(customer_id, chat_id):
+    """
+    Convert a legacy ``{"chat": [...]}`` transcript into the append-only JSONL format.
+
+    Runs under the transcript's ``flock``, so concurrent workers migrate a chat once.
+    """
+    legacy_path = get_legacy_transcript_path(customer_id, chat_id)
+    if not os.path.exists(legacy_path):
+        return
+    file_path = get_transcript_path(customer_id, chat_id)
+    with locked_transcript(file_path):
+        # Another worker may have migrated it while this one waited for the lock
+        try:
+            with open(legacy_path, "r") as f:
+                chat_data = json.load(f)
+        except FileNotFoundError:
+            return
+
+        # Entries appended before the migration ran go after the legacy history
+        temp_path = f"{file_path}.{uuid.uuid4().hex}.migrating"
+        with open(temp_path, "w") as f:
+            for entry in chat_data.get("chat", []):
+                f.write(json.dumps(entry) + "\n")
+            with open(file_path, "r") as current:
+                f.writelines(current)
+        os.replace(temp_path, file_path)
+        os.remove(legacy_path)
+
+
+def append_transcript(customer_id, chat_id, query, answer):
+    """
+    Append one question/answer pair to the chat's transcript.
+
+    Writes are a single appended line, serialised per chat within the process by a
+    lock and across workers by ``flock``, so concurrent answers never overwrite each
+    other and the cost of a write does not grow with the length of the chat.
+    """
+    os.makedirs(f"{TRANSCRIPT_ROOT}/{customer_id}/data", exist_ok=True)
+    line = json.dumps({"user": query, "answer": answer}) + "\n"
+    with get_chat_lock(customer_id, chat_id):
+        migrate_transcript(customer_id, chat_id)
+        with locked_transcript(get_transcript_path(customer_id, chat_id)) as f:
+            f.write(line)
+            f.flush()
+            if settings.TRANSCRIPT_FSYNC:
+                os.fsync(f.fileno())
+    storage_usage.add(customer_id, len(line.encode("utf-8")))
+
+
+def transcript_exists(customer_id, chat_id):
+    return os.path.exists(get_transcript_path(customer_id, chat_id)) or os.path.exists(
+        get_legacy_transcript_path(customer_id, chat_id)
+    )
+
+
+def iter_transcript_json(customer_id, chat_id):
+    """Yield the transcript as the ``{"chat": [...]}`` document served by ``/chat/download``."""
+    with get_chat_lock(customer_id, chat_id):
+        migrate_transcript(customer_id, chat_id)
+    yield '{"chat": ['
+    with open(get_transcript_path(customer_id, chat_id), "r") as f:
+        separator = ""
+        for line in f:
+            line = line.strip()
+            if line:
+                yield separator + line
+                separator = ", "
+    yield "]}"
+
+
+def migrate_all_transcripts(root=TRANSCRIPT_ROOT):
+    for customer_id in os.listdir(root):
+        data_folder = os.path.join(root, customer_id, "data")
+        if not os.path.isdir(data_folder):
+            continue
+        for filename in os.listdir(data_folder):
+            if filename.endswith(".json"):
+                migrate_transcript(customer_id, filename[: -len(".json")])
+
+
+if __name__ == "__main__":
+    migrate_all_transcripts()
@@ -1,4 +1,6 @@
 import base64
+import datetime
+import json
 import math
 import re
 import uuid
@@ -99,6 +101,25 @@ def format_page_content(raw_text):
     return formatted_text
 
 
+def sse_event(event, data):
+    # Format a server-sent event frame with a JSON payload
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def encode_cursor(updated_at, id):
+    # Opaque keyset pagination cursor for (updated_at, id) ordered listings
+    raw = f"{updated_at.isoformat()}|{id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        updated_at, id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|")
+        return datetime.datetime.fromisoformat(updated_at), uuid.UUID(id)
+    except Exception as e:
+        raise ValueError("Invalid cursor") from e
+
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 